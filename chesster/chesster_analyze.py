@@ -4,7 +4,12 @@ from os import path
 from bptbx.b_logging import setup_logging
 from multiprocessing import cpu_count
 from chesster.core.uci_frontend import ChessterUciFrontend
+from chesster.core.engine_pool import ChessterEnginePool
 from chesster.core.analyzer import ChessterAnalyzer
+from chesster.core.game_index import ChessterGameSelection
+from chesster.core.eval_cache import ChessterEvalCache
+from chesster.core.opening_book import ChessterOpeningBook
+from chesster.core.stats import ChessterStats, PROFILERS
 
 parser = argparse.ArgumentParser(
     description='Analyze and annotate games provided by a PGN file.')
@@ -15,10 +20,53 @@ parser.add_argument('-o', metavar='<OUTPUT-DIR>',
 parser.add_argument('-t', metavar='<T_MS>', default=5000,
                     help='Engine time per move in ms (default: 5000).')
 parser.add_argument('-r', metavar='<PATTERN_FILE>', default=None,
-                    help='Engine time per move in ms (default: 5000).')
+                    help='Tag replace pattern file.')
+parser.add_argument('-j', metavar='<JOBS>', default=1, type=int,
+                    help='Number of games analyzed in parallel (default: 1).')
+parser.add_argument('-n', metavar='<THREADS>', default=None, type=int,
+                    help='Engine threads per job (default: cores / jobs).')
+parser.add_argument('-m', metavar='<HASH_MB>', default=32, type=int,
+                    help='Engine hash size per job in MB (default: 32).')
+parser.add_argument('-e', metavar='<CACHE_DB>', default=None,
+                    help='Evaluation cache database (default: memory only).')
+parser.add_argument('-a', metavar='<MODE>', default='forward',
+                    choices=ChessterAnalyzer.analysis_modes,
+                    help='Analysis mode, forward, reverse or triage ' +
+                    '(default: forward).')
+parser.add_argument('-b', action='store_true',
+                    help='Do not analyze opening book moves.')
+parser.add_argument('-u', metavar='<BOOK_PGN>', action='append',
+                    help='Additional opening book PGN (implies -b).')
+parser.add_argument('-z', action='store_true',
+                    help='Search each unique position of all games once ' +
+                    '(forward mode only).')
+parser.add_argument('-c', metavar='<CHECKPOINT>', default=None,
+                    choices=ChessterAnalyzer.checkpoint_modes,
+                    help='Journal finished games (game) or also each ' +
+                    'searched position (ply) to resume an interrupted run.')
+parser.add_argument('-g', metavar='<GAMES>', default=None,
+                    help='Analyze only these game numbers, e.g. ' +
+                    '1-10,25,100- (builds a game index).')
+parser.add_argument('-w', metavar='<TAG=PATTERN>', action='append',
+                    help='Analyze only games whose tag matches the ' +
+                    'pattern, e.g. White=Carlsen*, can be repeated ' +
+                    '(builds a game index).')
+parser.add_argument('-x', action='store_true',
+                    help='Use pgn-extract instead of the built-in PGN reader.')
+parser.add_argument('-k', action='store_true',
+                    help='Keep intermediate analysis stages (debug).')
 parser.add_argument('-p', action='store_true',
                     help='Generate playbook with all games.')
 parser.add_argument('-d', action='store_true', help='Delete source file.')
+parser.add_argument('-s', '--stats', action='store_true',
+                    help='Print stage timings and write them to ' +
+                    'chesster_stats.json in the output folder.')
+parser.add_argument('-f', metavar='<PROFILE_DIR>', default=None,
+                    help='Write a profile per game to this folder.')
+parser.add_argument('-l', metavar='<PROFILER>', default='cprofile',
+                    choices=PROFILERS,
+                    help='Profiler, cprofile or pyinstrument ' +
+                    '(default: cprofile).')
 parser.add_argument('-v', action='store_true',
                     help='Verbose output.')
 args = parser.parse_args()
@@ -28,20 +76,49 @@ if not args.i:
     exit()
 if not args.o:
     args.o = path.dirname(args.i)
+game_selection = None
+if args.g or args.w:
+    try:
+        game_selection = ChessterGameSelection(args.g, args.w)
+    except ValueError as e:
+        parser.error(str(e))
 
 setup_logging(args.v)
 
-chesster_server = ChessterUciFrontend()
+chesster_server = None
+engine_pool = None
+eval_cache = ChessterEvalCache(args.e)
+opening_book = None
+stats = ChessterStats(args.f, args.l)
 try:
-    options = {
-        'setoption name Hash value 32',
-        'setoption name Threads value {}'.format(cpu_count()),
-        'setoption name Skill Level value 20',
-    }
-    chesster_server.init_engine(options)
-    chesster_analyser = ChessterAnalyzer(chesster_server)
+    if args.b or args.u:
+        opening_book = ChessterOpeningBook(args.u)
+    if args.j > 1:
+        engine_pool = ChessterEnginePool(args.j, args.n, args.m,
+                                         cache=eval_cache)
+        chesster_server = engine_pool.engines[0]
+    else:
+        chesster_server = ChessterUciFrontend(cache=eval_cache)
+        options = {
+            'setoption name Hash value {}'.format(args.m),
+            'setoption name Threads value {}'.format(args.n or cpu_count()),
+            'setoption name Skill Level value 20',
+        }
+        chesster_server.init_engine(options)
+    chesster_analyser = ChessterAnalyzer(chesster_server, engine_pool, args.x,
+                                         args.k, args.a, opening_book, stats,
+                                         args.z, args.c, game_selection)
     chesster_analyser.analyze(args.i, args.o, args.t, args.p, args.d, args.r)
+    if args.stats:
+        print(stats.get_table())
+        stats.write_report(path.join(args.o, 'chesster_stats.json'))
 except KeyboardInterrupt:
     print('Aborted.')
 finally:
-    chesster_server.shutdown()
+    if engine_pool:
+        engine_pool.shutdown()
+    elif chesster_server:
+        chesster_server.shutdown()
+    eval_cache.close()
+    if opening_book:
+        opening_book.close()
@@ -14,7 +14,9 @@ parser.add_argument('-v', action='store_true',
 parser.add_argument('-c', metavar='<INTERVAL>', default=30,
                     help='Worker interval in seconds (0 = single run).')
 parser.add_argument('-r', metavar='<PATTERN_FILE>', default=None,
-                    help='Engine time per move in ms (default: 5000).')
+                    help='Tag replace pattern file.')
+parser.add_argument('-e', metavar='<CACHE_DB>', default=None,
+                    help='Evaluation cache database (default: memory only).')
 args = parser.parse_args()
 
 setup_logging(args.v)
@@ -25,5 +27,5 @@ if not args.i:
     exit()
 
 daemon = ChessterDaemon(args.c)
-daemon.configure_daemon(args.i, args.t, args.r)
+daemon.configure_daemon(args.i, args.t, args.r, args.e)
 daemon.start()
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os import environ, path
+from shutil import rmtree
+from timeit import default_timer
+from tabulate import tabulate
+from bptbx.b_logging import setup_logging
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlencode
+except ImportError:  # python 2
+    from urllib2 import urlopen
+    from urllib import urlencode
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the analysis pipeline, UCI frontend and server.')
+parser.add_argument('-o', metavar='<RESULT_FILE>', default=None,
+                    help='JSON file to store the results in.')
+parser.add_argument('-c', metavar='<BASELINE_FILE>', default=None,
+                    help='JSON results of an earlier run to compare with.')
+parser.add_argument('-b', metavar='<BENCHMARK>', action='append',
+                    help='Benchmark to run, can be repeated ' +
+                    '(default: all).')
+parser.add_argument('-g', metavar='<GAMES>', default=4, type=int,
+                    help='Games per analysis run (default: 4).')
+parser.add_argument('-t', metavar='<T_MS>', default=10, type=int,
+                    help='Engine time per move in ms (default: 10).')
+parser.add_argument('-n', metavar='<REPEAT>', default=1000, type=int,
+                    help='Repetitions of micro benchmarks (default: 1000).')
+parser.add_argument('-q', metavar='<REQUESTS>', default=100, type=int,
+                    help='Requests per server endpoint (default: 100).')
+parser.add_argument('-v', action='store_true',
+                    help='Verbose output.')
+args = parser.parse_args()
+
+setup_logging(args.v)
+
+# results are only reproducible with the fake engine, it can be replaced by
+# setting CHESSTER_ENGINE to the path of a real engine
+environ.setdefault('CHESSTER_ENGINE', 'fake')
+environ.setdefault('CHESSTER_FAKE_LATENCY', 'movetime')
+
+from chesster.core.uci_frontend import ChessterUciFrontend
+from chesster.core.board import ChessterBoard
+from chesster.core.analyzer import ChessterAnalyzer
+from chesster.core.position import Position
+from chesster.core.pgn import read_games
+from chesster.core.notation import san_to_lan, NotationError
+from chesster.core.externals import get_pgn_extract_opening_book
+from chesster.core.uci_info import parse_info
+
+SAMPLE_GAME = '''[Event "Friendly game"]
+[Site "ChessTime"]
+[Date "2014.09.16"]
+[Round "{}"]
+[White "Player, White"]
+[Black "Player, Black"]
+[Result "1-0"]
+
+1. e4 c5 2. Nf3 e6 3. c4 Nc6 4. Be2 d5 5. d3 d4 6. O-O Bd6
+7. Bd2 Nf6 8. a3 O-O 9. b4 cxb4 10. axb4 e5 11. b5 Ne7
+12. c5 Bc7 13. b6 axb6 14. Rxa8 bxc5 15. Qc2 Qd6 16. Na3
+Bd7 17. Nc4 Qc6 18. Qa2 Rxa8 19. Qxa8+ Nc8 20. Ra1 Ne8
+21. Nfxe5 Nb6 22. Nxb6 Qd6 23. Nbxd7 f6 24. Qxe8+ 1-0
+'''
+"""Game used for all benchmarks, the round is set per copy"""
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def get_sample_fen_history():
+    game = next(read_games(SAMPLE_GAME.format(1).splitlines(True)))
+    chessgame = ChessterBoard()
+    for san in game.moves:
+        chessgame.apply_move(san_to_lan(chessgame, san))
+    return game.moves, chessgame.fen_history
+
+
+def get_distinct_fens(count):
+    """Returns up to count distinct positions of the ECO opening lines."""
+
+    fens = []
+    seen = set()
+    with open(get_pgn_extract_opening_book()) as eco_fh:
+        for game in read_games(eco_fh):
+            chessgame = ChessterBoard()
+            try:
+                for san in game.moves:
+                    chessgame.apply_move(san_to_lan(chessgame, san))
+            except (NotationError, ValueError):
+                continue
+            for fen in chessgame.fen_history:
+                position = ' '.join(fen.split()[0:4])
+                if position in seen:
+                    continue
+                seen.add(position)
+                fens.append(fen)
+                if len(fens) == count:
+                    return fens
+    return fens
+
+
+def get_engine():
+    engine = ChessterUciFrontend()
+    engine.init_engine({
+        'setoption name Hash value 32',
+        'setoption name Threads value 1',
+        'setoption name Skill Level value 20',
+    })
+    return engine
+
+
+def benchmark_analysis(workdir):
+    """Games and plies analyzed per second, overhead per ply on top of the
+    engine's time and mean depth of the final search result per ply for
+    each analysis mode. The fake engine reports a constant depth, compare
+    depths with CHESSTER_ENGINE set to a real engine."""
+
+    pgn_file = path.join(workdir, 'games.pgn')
+    with open(pgn_file, 'w') as ofile:
+        for game_idx in range(args.g):
+            ofile.write(SAMPLE_GAME.format(game_idx + 1) + '\n')
+    plies = args.g * (len(get_sample_fen_history()[1]))
+    results = {}
+    engine = get_engine()
+    try:
+        # warm up, e.g. loading the ECO classification
+        ChessterAnalyzer(engine).analyze(pgn_file, workdir, args.t, False,
+                                         False)
+        for mode in ChessterAnalyzer.analysis_modes:
+            # start each mode with an empty hash table
+            engine.eval_uci('ucinewgame')
+            analyzer = ChessterAnalyzer(engine, analysis_mode=mode)
+            start = default_timer()
+            analyzer.analyze(pgn_file, workdir, args.t, False, False)
+            elapsed = default_timer() - start
+            counters = analyzer.stats.get_report()['counters']
+            results[mode] = {
+                'games_per_s': args.g / elapsed,
+                'plies_per_s': plies / elapsed,
+                'overhead_ms_per_ply': (elapsed * 1000.0 -
+                                        plies * args.t) / plies,
+                'mean_depth': float(counters.get('searched_depth', 0)) /
+                max(1, counters.get('searched_plies', 0)),
+            }
+    finally:
+        engine.shutdown()
+    return results
+
+
+def benchmark_eval_uci_sync(workdir):
+    """Round-trip latency of a synchronous UCI command."""
+
+    engine = get_engine()
+    latencies = []
+    try:
+        for _ in range(args.n):
+            start = default_timer()
+            engine._eval_uci_sync('isready')
+            latencies.append((default_timer() - start) * 1000000.0)
+    finally:
+        engine.shutdown()
+    return {'isready': {
+        'mean_us': sum(latencies) / len(latencies),
+        'p50_us': get_percentile(latencies, 0.5),
+        'p95_us': get_percentile(latencies, 0.95),
+        'p99_us': get_percentile(latencies, 0.99),
+    }}
+
+
+def benchmark_position(workdir):
+    """Positions constructed and annotated per second."""
+
+    moves, fen_history = get_sample_fen_history()
+    infos = [parse_info('info depth 20 seldepth 28 multipv 1 score cp {} '
+                        'nodes 123456 nps 1000000 time 123 pv e2e4 e7e5 '
+                        'g1f3 b8c6'.format((ply * 37) % 300 - 150))
+             for ply in range(len(fen_history))]
+    start = default_timer()
+    count = 0
+    while count < args.n:
+        positions = []
+        for ply, fen in enumerate(fen_history):
+            move = moves[ply] if ply < len(moves) else None
+            positions.append(Position(fen, move, infos[ply]))
+        next_position = None
+        for position in reversed(positions):
+            position.annotate_position(next_position)
+            next_position = position
+        count += len(positions)
+    elapsed = default_timer() - start
+    return {'construct_and_annotate': {'positions_per_s': count / elapsed}}
+
+
+def benchmark_replay(workdir):
+    """Plies replayed from SAN to LAN and FEN per second."""
+
+    game = next(read_games(SAMPLE_GAME.format(1).splitlines(True)))
+    start = default_timer()
+    count = 0
+    while count < args.n:
+        chessgame = ChessterBoard()
+        for san in game.moves:
+            chessgame.apply_move(san_to_lan(chessgame, san))
+        count += len(game.moves)
+    elapsed = default_timer() - start
+    return {'san_to_fen': {'plies_per_s': count / elapsed}}
+
+
+def benchmark_tag_fixing(workdir):
+    """Tags fixed per second with the default tag replace patterns."""
+
+    tags = ['[Event "Let\'s Play!"]', '[Site "ChessTime"]',
+            '[Date "2014.09.16"]', '[Round "?"]', '[White "Player, White"]',
+            '[Black "Player, Black"]', '[Result "1-0"]', '[ECO "B40"]']
+    analyzer = ChessterAnalyzer(None)
+    tag_rules = analyzer._load_tag_rules(None)
+    start = default_timer()
+    for idx in range(args.n):
+        analyzer._fix_tag(tags[idx % len(tags)], tag_rules)
+    elapsed = default_timer() - start
+    return {'fix_tag': {'tags_per_s': args.n / elapsed}}
+
+
+def benchmark_server(workdir):
+    """Requests per second of the server's search endpoints. The response
+    and evaluation caches are disabled and each request searches another
+    position, so every request is answered by an engine search."""
+
+    port = get_free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'chesster.chesster_server', '-p', str(port),
+         '-t', '0', '-n'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        base_url = 'http://localhost:{}'.format(port)
+        wait_for_server(server, base_url)
+        fens = get_distinct_fens(2 * args.q)
+        results = {}
+        for endpoint_idx, endpoint in enumerate(['bestmove', 'evalpos']):
+            start = default_timer()
+            for idx in range(args.q):
+                # vary the search time once all positions were searched
+                fen_idx = endpoint_idx * args.q + idx
+                query = urlencode({'fen': fens[fen_idx % len(fens)],
+                                   'ttm': args.t + fen_idx // len(fens)})
+                urlopen('{}/{}?{}'.format(base_url, endpoint, query)).read()
+            elapsed = default_timer() - start
+            results[endpoint] = {'requests_per_s': args.q / elapsed}
+        return results
+    finally:
+        server.kill()
+        server.wait()
+
+
+def get_free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_server(server, base_url, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise IOError('Server exited: {}'.format(server.stdout.read()))
+        try:
+            urlopen(base_url + '/').read()
+            return
+        except IOError:
+            time.sleep(0.1)
+    raise IOError('Server did not start within {} s.'.format(timeout))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=path.dirname(path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline, current):
+    rows = []
+    for benchmark in sorted(current):
+        for case in sorted(current[benchmark]):
+            for metric, value in sorted(current[benchmark][case].items()):
+                try:
+                    base_value = baseline[benchmark][case][metric]
+                except KeyError:
+                    base_value = None
+                change = None
+                if base_value:
+                    change = '{:+.1f}%'.format(
+                        (value - base_value) * 100.0 / abs(base_value))
+                rows.append([benchmark, case, metric, base_value, value,
+                             change])
+    return tabulate(rows, ['benchmark', 'case', 'metric', 'baseline',
+                           'current', 'change'], tablefmt='psql',
+                    floatfmt='.2f')
+
+
+benchmarks = {
+    'analysis': benchmark_analysis,
+    'eval_uci_sync': benchmark_eval_uci_sync,
+    'position': benchmark_position,
+    'replay': benchmark_replay,
+    'tag_fixing': benchmark_tag_fixing,
+    'server': benchmark_server,
+}
+selected = args.b or sorted(benchmarks)
+for name in selected:
+    if name not in benchmarks:
+        print('Unknown benchmark \'{}\', choose from: {}'.format(
+            name, ', '.join(sorted(benchmarks))))
+        exit(1)
+
+report = {
+    'timestamp': int(round(time.time() * 1000)),
+    'commit': get_commit(),
+    'python': sys.version.split(' ')[0],
+    'engine': environ['CHESSTER_ENGINE'],
+    'settings': {'games': args.g, 'movetime': args.t, 'repeat': args.n,
+                 'requests': args.q},
+    'results': {},
+}
+workdir = tempfile.mkdtemp(prefix='chesster_benchmark_')
+try:
+    for name in selected:
+        logging.info('-- running benchmark {}'.format(name))
+        report['results'][name] = benchmarks[name](workdir)
+finally:
+    rmtree(workdir, ignore_errors=True)
+
+baseline = {}
+if args.c:
+    with open(args.c) as ifile:
+        baseline = json.load(ifile)['results']
+print(compare_results(baseline, report['results']))
+if args.o:
+    with open(args.o, 'w') as ofile:
+        json.dump(report, ofile, indent=2, sort_keys=True)
+    logging.info('-- results written to {}'.format(args.o))
@@ -8,26 +8,26 @@ parser.add_argument('-v', action='store_true',
         help='Verbose output.')
 parser.add_argument('-l', metavar='<LEVEL>', default=1,
         help='Engine level (1-20).')
+parser.add_argument('-n', action='store_true',
+        help='Do not let the engine think on your time (pondering).')
 args = parser.parse_args()
 
 from bptbx.b_logging import setup_logging
 from bptbx import b_legacy
 setup_logging(args.v)
 
-from Chessnut import Game
-from Chessnut.game import InvalidMove
-from chesster.core.position import Position
+from chesster.core.board import ChessterBoard, IllegalMove
 from chesster.core.uci_frontend import ChessterUciFrontend
 
 uci_frontend = ChessterUciFrontend()
-chessgame = Game()
+chessgame = ChessterBoard(validate=True)
 options = {
            'setoption name Skill Level value {}'.format(args.l),
            'setoption name Hash value 32',
            'setoption name Threads value 2'
         }
 uci_frontend.init_engine(options)
-print (Position(chessgame.get_fen()).fen_to_string_board())
+print (chessgame.get_string_board())
 
 while True:
     if not args.b: # if user plays black, skip first user move
@@ -41,18 +41,28 @@ while True:
                 exit(0)
             if raw is None or raw == '':
                 print ('Invalid input! Please try again.')
+            # moves are accepted in any case, the engine reports them in
+            # lower case
+            move = raw.lower()
             try:
-                chessgame.apply_move(raw)
-                print (Position(chessgame.get_fen()).fen_to_string_board())
+                chessgame.apply_move(move)
+                print (chessgame.get_string_board())
                 break
-            except InvalidMove as e:
-                print ('{0}'.format(e.message))
+            except IllegalMove as e:
+                print ('{0}'.format(e))
 
     args.b = False
 
-    # get move from engine
+    # get move from engine, right away if it pondered on the user's move
     print ('-- Waiting for engine move')
-    engine_move = uci_frontend.bestmove(chessgame.get_fen(), 2500).pop()
+    if uci_frontend.pondering and uci_frontend.pondering[1] == move:
+        _, engine_move = uci_frontend.ponderhit()
+    else:
+        engine_move = uci_frontend.bestmove(chessgame.get_fen(), 2500).pop()
     print ('-- Engine played {0}'.format(engine_move))
     chessgame.apply_move(engine_move)
-    print (Position(str(chessgame)).fen_to_string_board())
+    print (chessgame.get_string_board())
+
+    # let the engine think about its next move while the user thinks
+    if not args.n:
+        uci_frontend.ponder(chessgame.get_fen(), 2500)
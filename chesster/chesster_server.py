@@ -7,6 +7,21 @@ parser.add_argument('-d', metavar='<HOSTNAME>', default='localhost',
                     help='Hostname (default: localhost).')
 parser.add_argument('-p', metavar='<PORT>', default=8000,
                     help='Port (default: 8000).')
+parser.add_argument('-e', metavar='<CACHE_DB>', default=None,
+                    help='Evaluation cache database (default: memory only).')
+parser.add_argument('-n', action='store_true',
+                    help='Disable the evaluation cache.')
+parser.add_argument('-j', metavar='<ENGINES>', default=1, type=int,
+                    help='Number of engines serving requests (default: 1).')
+parser.add_argument('-q', metavar='<QUEUE>', default=16, type=int,
+                    help='Requests waiting for an engine before new ones ' +
+                    'are rejected (default: 16).')
+parser.add_argument('-w', metavar='<TIMEOUT_S>', default=60.0, type=float,
+                    help='Request timeout in seconds, searches are stopped ' +
+                    'when it expires (default: 60).')
+parser.add_argument('-t', metavar='<TTL_S>', default=60.0, type=float,
+                    help='Seconds /bestmove and /evalpos responses are ' +
+                    'cached, 0 disables the cache (default: 60).')
 parser.add_argument('-v', action='store_true',
                     help='Verbose output.')
 args = parser.parse_args()
@@ -15,6 +30,13 @@ from bptbx.b_logging import setup_logging
 setup_logging(args.v)
 
 from chesster.core.server import ChessterServer
+from chesster.core.eval_cache import ChessterEvalCache
 logging.info('Go to http://{}:{}/?com=uci to see if the server is up!'
              .format(args.d, args.p))
-chesster_server = ChessterServer(args.d, args.p)
+eval_cache = None if args.n else ChessterEvalCache(args.e)
+try:
+    chesster_server = ChessterServer(args.d, args.p, eval_cache, args.j,
+                                     args.q, args.w, args.t)
+finally:
+    if eval_cache:
+        eval_cache.close()
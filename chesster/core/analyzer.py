@@ -3,14 +3,25 @@ from os import makedirs, listdir, rename
 from os import path
 import re
 from shutil import copy
+from threading import Lock
 from time import time
-from Chessnut import Game
-from dateutil.parser import parse
 from tabulate import tabulate
 from bptbx.b_cmdline import get_command_process
 from bptbx.b_iotools import remove_silent
 from bptbx import b_legacy
+from chesster.core.board import ChessterBoard, DEFAULT_FEN
 from chesster.core.position import Position
+from chesster.core.pgn import read_games, read_tags, format_pgn_game, \
+    format_tag, format_game, get_movetext_tokens, get_fen_move, \
+    SEVEN_TAG_ROSTER
+from chesster.core.notation import san_to_lan, lan_to_san, \
+    replay_lan_moves, NotationError
+from chesster.core.eco import get_eco_classifier
+from chesster.core.stats import ChessterStats
+from chesster.core.search_plan import ChessterSearchPlan
+from chesster.core.journal import ChessterJournal
+from chesster.core.game_index import ChessterGameIndex
+from chesster.core.tag_rules import get_tag_rules, parse_date
 from chesster.core.tagset import get_pgn_tag_string, ChessterTagSet, \
     append_chesster_tagset_ordered
 
@@ -21,43 +32,327 @@ class ChessterAnalyzer:
     """Path to this Python script"""
     server = None
     """Currently active Chesster server instance"""
+    engine_pool = None
+    """Optional engine pool to analyze several games in parallel"""
     game_tags = {}
     """Maps the game id to the key/values of the game's tag information"""
     temporary_files = []
-    """A list of all files created during analysis expect single game files"""
+    """A list of all temporary files created during analysis"""
     playbook_name = '_full-playbook.pgn'
     """Name of output playbook file"""
-
-    def __init__(self, server):
+    use_pgn_extract = False
+    """Use pgn-extract subprocesses instead of the built-in PGN reader"""
+    dump_stages = False
+    """Debug switch to write the intermediate stages of each game to files"""
+    analysis_modes = ['forward', 'reverse', 'triage']
+    """Supported modes to search the positions of a game"""
+    analysis_mode = 'forward'
+    """Mode to search the positions of a game. In reverse mode the game is
+    walked backwards while sending the move list, so the engine's hash table
+    already holds the results of the following positions. In triage mode all
+    positions are searched to a low depth first and only suspicious moves
+    are searched again with the full engine time."""
+    triage_depth = 8
+    """Search depth of the shallow pass in triage mode"""
+    triage_threshold = 0.25
+    """Minimal score loss of a move in the shallow pass to search it again
+    with full engine time, below the mistake threshold of 0.5"""
+    triage_saved_ms = 0.0
+    """Engine time saved by triage mode compared to a full-time run"""
+    opening_book = None
+    """Optional opening book, moves into book positions are not analyzed"""
+    stats = None
+    """Timers and counters of the analysis stages"""
+    plan_searches = False
+    """Collect the positions of all games up front and search each unique
+    position once (forward mode only). All games are kept in memory."""
+    search_plan = None
+    """Unique positions and their results of the current run if searches
+    are planned"""
+    checkpoint_modes = ['game', 'ply']
+    """Supported granularities of the checkpoint journal"""
+    checkpoint = None
+    """Write a checkpoint journal after each game or also after each
+    searched position, so an interrupted run resumes there. Triage mode
+    resumes finished games only. None disables the journal."""
+    journal = None
+    """Checkpoint journal of the current run"""
+    game_selection = None
+    """Analyze only the games of the input matching this
+    ChessterGameSelection. They are found through a game index and read
+    from their byte ranges. None analyzes all games."""
+
+    def __init__(self, server, engine_pool=None, use_pgn_extract=False,
+                 dump_stages=False, analysis_mode='forward',
+                 opening_book=None, stats=None, plan_searches=False,
+                 checkpoint=None, game_selection=None):
         self.server = server
+        self.stats = stats or ChessterStats()
+        self.opening_book = opening_book
+        self.engine_pool = engine_pool
+        self.use_pgn_extract = use_pgn_extract
+        self.dump_stages = dump_stages
+        if analysis_mode not in self.analysis_modes:
+            raise ValueError('Unknown analysis mode \'{}\'.'
+                             .format(analysis_mode))
+        self.analysis_mode = analysis_mode
+        if plan_searches and analysis_mode != 'forward':
+            raise ValueError('Search planning requires forward mode.')
+        self.plan_searches = plan_searches
+        if checkpoint and checkpoint not in self.checkpoint_modes:
+            raise ValueError('Unknown checkpoint mode \'{}\'.'
+                             .format(checkpoint))
+        self.checkpoint = checkpoint
+        self.journal = None
+        if game_selection and use_pgn_extract:
+            raise ValueError('Game selection requires the built-in PGN '
+                             'reader.')
+        self.game_selection = game_selection
+        self.search_plan = None
+        self._planned_replays = {}
+        self.triage_saved_ms = 0.0
+        self.triage_lock = Lock()
+        if use_pgn_extract and not server.pgn_extract_path:
+            raise IOError('pgn-extract is not available.')
 
     def analyze(self, pgn_in_file, pgn_out_folder, engine_movetime,
                 create_playbook, delete_source, pattern_file=None):
+        with self.stats.timer('analyze'):
+            try:
+                self._analyze(pgn_in_file, pgn_out_folder, engine_movetime,
+                              create_playbook, delete_source, pattern_file)
+            finally:
+                # an interrupted run keeps its journal to resume from
+                if self.journal:
+                    self.journal.close()
+                    self.journal = None
 
-        pattern_file = self._load_pattern_file(pattern_file)
+    def _analyze(self, pgn_in_file, pgn_out_folder, engine_movetime,
+                 create_playbook, delete_source, pattern_file=None):
 
-        keep_temp_files = False  # dev
+        tag_rules = self._load_tag_rules(pattern_file)
 
         pgn_in_file, pgn_out_folder = self._verify_io_settings(
             pgn_in_file, pgn_out_folder)
+        if self.checkpoint:
+            self.journal = self._open_journal(pgn_in_file, pgn_out_folder,
+                                              engine_movetime)
 
-        analysis_input_files = []
         analysis_output_files = []
 
+        # the built-in reader streams the games from the input file, while
+        # pgn-extract splits the input into single files first
+        pgn_in_fh = None
+        game_index = None
+        if self.use_pgn_extract:
+            logging.info('-- splitting input file..')
+            with self.stats.timer('split'):
+                games = self._split_games_pgn_extract(pgn_in_file,
+                                                      pgn_out_folder)
+        elif self.game_selection:
+            with self.stats.timer('index'):
+                game_index = ChessterGameIndex(pgn_in_file)
+            games = self._read_selected_games(game_index)
+        else:
+            pgn_in_fh = open(pgn_in_file)
+            games = self._read_games(pgn_in_fh)
+
+        # analyze games
+        try:
+            if self.plan_searches:
+                games = self._plan_searches(games, engine_movetime)
+            logging.info('-- analyzing games..')
+            if self.engine_pool:
+                # games are distributed over the pool but results keep the
+                # input order, so the output equals a sequential run
+                analysis_output_files = self.engine_pool.map(
+                    lambda engine, game_entry: self._do_game_analysis(
+                        game_entry[0], game_entry[1], pgn_out_folder,
+                        engine_movetime, tag_rules, engine),
+                    games)
+                analysis_output_files = [file_out for file_out
+                                         in analysis_output_files if file_out]
+            else:
+                for game_id, game in games:
+                    file_out = self._do_game_analysis(
+                        game_id, game, pgn_out_folder, engine_movetime,
+                        tag_rules)
+                    if file_out:
+                        analysis_output_files.append(file_out)
+        finally:
+            if pgn_in_fh:
+                pgn_in_fh.close()
+            if game_index:
+                game_index.close()
+
+        if create_playbook:
+            with self.stats.timer('playbook'):
+                self._create_playbook(analysis_output_files, pgn_out_folder)
+
+        # cleanup
+        if not self.dump_stages:
+            logging.info('-- removing temporary files..')
+            for temporary_file in self.temporary_files:
+                remove_silent(temporary_file)
+        self.temporary_files = []
+
+        for analysis_output_file in analysis_output_files:
+            game_id = path.basename(analysis_output_file).split('_')[0]
+            to_name = path.join(pgn_out_folder,
+                                self._get_filesafe_game_string(game_id))
+            logging.info('{} <<< {}'
+                         .format(to_name, analysis_output_file))
+            with self.stats.timer('rename'):
+                remove_silent(to_name)
+                rename(analysis_output_file, to_name)
+
+        if delete_source and self.game_selection:
+            logging.warning('Keeping {} as only selected games were '
+                            'analyzed.'.format(pgn_in_file))
+        elif delete_source:
+            remove_silent(pgn_in_file)
+
+        if self.analysis_mode == 'triage':
+            logging.info('-- triage saved {:.0f} ms of engine time'
+                         .format(self.triage_saved_ms))
+        self.search_plan = None
+        self._planned_replays = {}
+        if self.journal:
+            self.journal.remove()
+            self.journal = None
+        logging.info('-- done processing')
+
+    def _open_journal(self, pgn_in_file, pgn_out_folder, engine_movetime):
+        """Opens the journal of the input file in the output folder. It is
+        only resumed if input file and analysis settings are unchanged."""
+
+        journal_file = path.join(pgn_out_folder, '{}.chesster_journal'
+                                 .format(path.basename(pgn_in_file)))
+        run = {
+            'input': pgn_in_file,
+            'mtime': repr(path.getmtime(pgn_in_file)),
+            'size': path.getsize(pgn_in_file),
+            'engine': str(self.server.engine_id),
+            'movetime': str(engine_movetime),
+            'mode': self.analysis_mode,
+            'plan': self.plan_searches,
+            'book': bool(self.opening_book),
+            'pgn_extract': self.use_pgn_extract,
+        }
+        return ChessterJournal(journal_file, run)
+
+    def _get_checkpoint(self, key):
+        """Returns (True, info) if the search key was journaled before,
+        otherwise (False, None)."""
+
+        if not self.journal or not self.journal.has_result(key):
+            return False, None
+        return True, self.journal.get_result(key)
+
+    def _save_checkpoint(self, key, info):
+        if self.journal and self.checkpoint == 'ply':
+            self.journal.add_result(key, info)
+
+    def _plan_searches(self, games, engine_movetime):
+        """Replays all games, searches each unique position among their
+        non-book positions once and returns the games for the analysis."""
+
+        logging.info('-- planning searches..')
+        planned_games = []
+        plan = ChessterSearchPlan()
+        with self.stats.timer('plan'):
+            for game_id, game in games:
+                if self.journal and self.journal.get_game(game_id):
+                    planned_games.append((game_id, game))
+                    continue
+                replay = self._replay_game(game_id, game)
+                if replay is None:
+                    continue
+                planned_games.append((game_id, game))
+                self._planned_replays[game_id] = replay
+                fen_history = replay[0].fen_history
+                for fen in fen_history[self._get_book_plies(fen_history):]:
+                    plan.add(fen)
+        positions = plan.get_unique_positions()
+        self.stats.count('planned_positions', plan.total)
+        self.stats.count('unique_positions', len(positions))
+        logging.info('-- {} of {} positions are unique, deduplication ratio '
+                     '{:.1%}'.format(len(positions), plan.total,
+                                     plan.get_dedup_ratio()))
+        if self.engine_pool:
+            results = self.engine_pool.map(
+                lambda engine, position: self._search_planned(
+                    engine, position, engine_movetime), positions)
+        else:
+            results = [self._search_planned(self.server, position,
+                                            engine_movetime)
+                       for position in positions]
+        for (key, _), info in zip(positions, results):
+            plan.set_result(key, info)
+        self.search_plan = plan
+        return planned_games
+
+    def _search_planned(self, engine, position, engine_movetime):
+        key, fen_string = position
+        checkpoint_key = 'position/{}'.format(key)
+        found, info = self._get_checkpoint(checkpoint_key)
+        if found:
+            return info
+        infos = self._search_fen(engine, fen_string, engine_movetime)
+        info = infos[0] if infos else None
+        self._save_checkpoint(checkpoint_key, info)
+        return info
+
+    def _search_fen(self, engine, fen_string, engine_movetime):
+        self.stats.count('searches')
+        with self.stats.timer('search', 'engine_ms'):
+            infos, _ = engine.search(fen_string, movetime=engine_movetime)
+        return infos
+
+    def _get_book_plies(self, fen_history):
+        if not self.opening_book:
+            return 0
+        return self.opening_book.get_book_plies(fen_history)
+
+    def _read_games(self, pgn_in_fh):
+        games = read_games(pgn_in_fh)
+        game_idx = 0
+        while True:
+            with self.stats.timer('read'):
+                game = next(games, None)
+            if game is None:
+                return
+            game_idx += 1
+            yield str(game_idx).zfill(5), game
+
+    def _read_selected_games(self, game_index):
+        selected = plies = 0
+        for game_number, offset, length, game_plies, _ in \
+                game_index.select(self.game_selection):
+            with self.stats.timer('read'):
+                game = game_index.read_game(offset, length)
+            selected += 1
+            plies += game_plies
+            yield str(game_number).zfill(5), game
+        logging.info('-- selected {} of {} games with {} plies'
+                     .format(selected, game_index.games, plies))
+
+    def _split_games_pgn_extract(self, pgn_in_file, pgn_out_folder):
+        analysis_input_files = []
+
         # list current files
         curr_files = listdir(pgn_out_folder)
 
-        # split PGN into single files
-        logging.info('-- splitting input file..')
         cmd = ('{0} {1} -#1'
                .format(self.server.pgn_extract_path, pgn_in_file))
-        p = get_command_process(cmd, pgn_out_folder, stdin=None, stdout=None)
-        p.wait()
+        with self.stats.timer('subprocess', 'subprocess_ms'):
+            p = get_command_process(cmd, pgn_out_folder, stdin=None,
+                                    stdout=None)
+            p.wait()
 
         # get new files
         new_files = list(filter(lambda x: x not in curr_files,
                                 listdir(pgn_out_folder)))
-        self.temporary_files += new_files
 
         # rename input files
         for name in new_files:
@@ -73,41 +368,10 @@ class ChessterAnalyzer:
                 pgn_out_folder, basename.zfill(5) + '_01_split.pgn')
             remove_silent(new_name)
             rename(old_name, new_name)
-            analysis_input_files.append(new_name)
-
-        logging.info('-- analyzing games..')
-
-        # analyze games
+            self.temporary_files.append(new_name)
+            analysis_input_files.append((basename.zfill(5), new_name))
         analysis_input_files.sort()
-        for analysis_input_file in analysis_input_files:
-            file_out = self._do_game_analysis(
-                analysis_input_file, pgn_out_folder, engine_movetime,
-                pattern_file)
-            analysis_output_files.append(file_out)
-
-        if create_playbook:
-            self._create_playbook(analysis_output_files, pgn_out_folder)
-
-        logging.info('-- removing temporary files..')
-
-        # cleanup
-        if not keep_temp_files:
-            for temporary_file in self.temporary_files:
-                remove_silent(temporary_file)
-
-        for analysis_output_file in analysis_output_files:
-            game_id = path.basename(analysis_output_file).split('_')[0]
-            to_name = path.join(pgn_out_folder,
-                                self._get_filesafe_game_string(game_id))
-            logging.info('{} <<< {}'
-                         .format(to_name, analysis_output_file))
-            remove_silent(to_name)
-            rename(analysis_output_file, to_name)
-
-        if delete_source:
-            remove_silent(pgn_in_file)
-
-        logging.info('-- done processing')
+        return analysis_input_files
 
     def _verify_io_settings(self, pgn_in_file, pgn_out_folder):
         if pgn_in_file == None:
@@ -137,29 +401,83 @@ class ChessterAnalyzer:
         )
         return filename
 
-    def _do_game_analysis(self, pgn_in_file, pgn_out_folder, engine_movetime,
-                          pattern_file):
-
-        self.temporary_files.append(pgn_in_file)
-        game_id = path.basename(pgn_in_file)
-        game_id = re.sub('_01_split\\.pgn$', '', game_id)
+    def _do_game_analysis(self, game_id, game, pgn_out_folder,
+                          engine_movetime, tag_rules, engine=None):
+        """Analyzes a single game, given as PgnGame or as a split file for
+        the pgn-extract backend, and writes the final PGN. Intermediate
+        stages are kept in memory. Returns None if the game was skipped."""
+
+        finished = self.journal.get_game(game_id) if self.journal else None
+        if finished:
+            logging.info('-- game #{} finished before, skipping'
+                         .format(game_id))
+            file_fin, self.game_tags[game_id] = finished
+            return file_fin
+        with self.stats.profile(game_id):
+            file_fin = self._do_game_analysis_stages(
+                game_id, game, pgn_out_folder, engine_movetime, tag_rules,
+                engine)
+        if file_fin is None:
+            return None
+        if self.journal:
+            self.journal.add_game(game_id, file_fin, self.game_tags[game_id])
+        return file_fin
 
-        chessgame, moves, result, _ = self._extract_chessgame(pgn_in_file)
-        file_annotated_game, positions = self._annotate_game(
-            chessgame, moves, game_id, pgn_out_folder, result, engine_movetime)
-        self.temporary_files.append(file_annotated_game)
-        file_fixed_tags, fixed_tags = self._extract_fixed_tags(
-            pgn_in_file, pgn_out_folder, game_id, positions, pattern_file)
-        self.temporary_files.append(file_fixed_tags)
+    def _do_game_analysis_stages(self, game_id, game, pgn_out_folder,
+                                 engine_movetime, tag_rules, engine=None):
+        if not self.use_pgn_extract:
+            self._dump_stage(pgn_out_folder, game_id, '01_split',
+                             format_pgn_game(game))
+        replay = self._planned_replays.pop(game_id, None)
+        if replay is None:
+            replay = self._replay_game(game_id, game)
+        if replay is None:
+            return None
+        chessgame, moves, result, _ = replay
+        self.stats.count('games')
+        self.stats.count('plies', len(moves))
+        with self.stats.timer('annotate'):
+            game_annotation, positions = self._annotate_game(
+                chessgame, moves, game_id, result, engine_movetime, engine)
+        self._dump_stage(pgn_out_folder, game_id, '02_annotated',
+                         game_annotation)
+        with self.stats.timer('tags'):
+            fixed_tags = self._extract_fixed_tags(
+                game, game_id, positions, tag_rules)
+        self._dump_stage(pgn_out_folder, game_id, '03_tagfix',
+                         '\n'.join(fixed_tags) + '\n')
         game_tags_for_id = self._extract_dict_from_tags(fixed_tags)
         self.game_tags[game_id] = game_tags_for_id
-        file_merged = self._merge_tags_and_annotations(
-            file_fixed_tags, file_annotated_game, pgn_out_folder, game_id)
-        self.temporary_files.append(file_merged)
-        file_fin = self._create_output_format(
-            file_merged, pgn_out_folder, game_id)
+        game_merged = self._merge_tags_and_annotations(
+            fixed_tags, game_annotation)
+        self._dump_stage(pgn_out_folder, game_id, '04_merged', game_merged)
+        with self.stats.timer('format'):
+            try:
+                game_fin = self._create_output_format(
+                    game_merged, game_id, fixed_tags, positions, result)
+            except ValueError as e:
+                # like games that cannot be replayed, a game whose output
+                # cannot be read back is skipped instead of aborting the run
+                logging.warning('Skipping game #{}: {}'.format(game_id, e))
+                self.stats.count('skipped_games')
+                return None
+        # the final PGN is the only file written per game
+        file_fin = path.join(pgn_out_folder, game_id + '_05_fin.pgn')
+        self._write_file(file_fin, game_fin)
         return file_fin
 
+    def _dump_stage(self, pgn_out_folder, game_id, stage, content):
+        if not self.dump_stages:
+            return
+        self._write_file(path.join(pgn_out_folder, '{}_{}.pgn'.format(
+            game_id, stage)), content)
+
+    def _write_file(self, file_path, content):
+        with self.stats.timer('write'):
+            with open(file_path, 'w') as ofile:
+                ofile.write(content)
+        self.stats.count('bytes_written', len(content))
+
     def _pgn_tag_to_keyvalue(self, pgn_tag):
         tag_sub = re.sub('[\[\]]', '', pgn_tag)
         key = tag_sub.split(' ')[0].strip().lower()
@@ -185,6 +503,7 @@ class ChessterAnalyzer:
                 ofile.write(line.strip() + '\n')
             ifile.close()
             ofile.write('\n')
+        self.stats.count('bytes_written', ofile.tell())
         ofile.close()
 
     def _compare_output_files(self, file1, file2):
@@ -201,66 +520,131 @@ class ChessterAnalyzer:
             return -1
         return 0
 
-    def _create_output_format(self, file_merged, pgn_out_folder, game_id):
-        file_fin = path.join(pgn_out_folder, game_id + '_05_fin.pgn')
+    def _create_output_format(self, game_merged, game_id, fixed_tags,
+                              positions, result):
         logging.info('-- creating output for game #{}'.format(game_id))
-        cmd = ('{0} {1} -s --output {2}'
-               .format(self.server.pgn_extract_path, path.join(pgn_out_folder, file_merged),
-                       file_fin))
-        p = get_command_process(cmd, stdout=None)
-        p.wait()
-
-        return file_fin
-
-    def _merge_tags_and_annotations(self, file_fixed_tags, file_annotated_game, pgn_out_folder, game_id):
-        ofile = open(path.join(pgn_out_folder,
-                               game_id + '_04_merged.pgn'), 'w')
-        # write  tags
-        ifile = open(path.join(pgn_out_folder, file_fixed_tags))
-        for line in ifile:
-            ofile.write(line.strip() + '\n')
-        ifile.close()
-        # write annotations
-        ifile = open(path.join(pgn_out_folder, file_annotated_game))
-        for line in ifile:
-            ofile.write(line.strip() + '\n')
-        ifile.close()
-        ofile.close()
-        return ofile.name
-
-    def _annotate_game(self, chessgame, moves, game_id, pgn_out_folder, result, engine_movetime):
+        if not self.use_pgn_extract:
+            tokens = self._get_annotated_movetext_tokens(positions, result)
+            game_fin = format_game(fixed_tags, tokens)
+            self._verify_output(game_fin, game_id, fixed_tags, positions,
+                                result)
+            return game_fin
+        cmd = '{0} -s'.format(self.server.pgn_extract_path)
+        with self.stats.timer('subprocess', 'subprocess_ms'):
+            p = get_command_process(cmd)
+            # We need to encode/decode the bytes when running on python 3
+            if not b_legacy.get_python_major_version() <= 2:
+                stdout_content, _ = p.communicate(game_merged.encode())
+                stdout_content = stdout_content.decode()
+            else:
+                stdout_content, _ = p.communicate(game_merged)
+        return ''.join(line.strip() + '\n'
+                       for line in stdout_content.splitlines())
+
+    def _verify_output(self, game_fin, game_id, fixed_tags, positions,
+                       result):
+        # the output is read again when the playbook is analyzed, so it
+        # must parse back to the same tags, moves and result
+        games = list(read_games(game_fin.splitlines(True)))
+        plies = len([position for position in positions
+                     if position.move_played])
+        if len(games) != 1 or len(games[0].tags) != len(fixed_tags) or \
+                len(games[0].moves) != plies or games[0].result != result:
+            raise ValueError('Output of game #{} cannot be read back:\n{}'
+                             .format(game_id, game_fin))
+
+    def _get_annotated_movetext_tokens(self, positions, result):
+        san_moves = []
+        nags = {}
+        comments = {}
+        variations = {}
+        played_positions = [position for position in positions
+                            if position.move_played]
+        for position in played_positions:
+            san_moves.append(lan_to_san(ChessterBoard(position.fen_string),
+                                        position.move_played))
+            move_count = len(san_moves)
+            if position.annotation == '??':
+                nags[move_count] = [4]
+            elif position.annotation == '?':
+                nags[move_count] = [2]
+            if position.comment:
+                comments[move_count] = position.comment
+            # on blunders append the full best line, on mistakes the first
+            # three moves of the best line
+            best_line = b_legacy.b_filter(
+                None, (position.best_line or '').split(' '))
+            if position.annotation == '?':
+                best_line = best_line[0:3]
+            if position.annotation and best_line:
+                variations[move_count] = [replay_lan_moves(
+                    position.fen_string, best_line)]
+        move_number = 1
+        white_move = True
+        if played_positions:
+            move_number, white_move = get_fen_move(
+                played_positions[0].fen_string)
+        return get_movetext_tokens(san_moves, result, nags, comments,
+                                   variations, move_number, white_move)
+
+    def _merge_tags_and_annotations(self, fixed_tags, game_annotation):
+        merged = [fixed_tag + '\n' for fixed_tag in fixed_tags]
+        merged.append(game_annotation)
+        return ''.join(merged)
+
+    def _annotate_game(self, chessgame, moves, game_id, result, engine_movetime,
+                       engine=None):
         logging.info('-- analysing game #{0}'.format(game_id))
+        engine = engine or self.server
 
         use_engine = True  # debug
         # analyze game through engine
         positions = []
-        move_idx = 0
-
-        # go through fen history and collect engine calculation
-        for fen in chessgame.fen_history:
-            try:
-                move = moves[move_idx]
-            except IndexError:
-                move = None
-            logging.debug(
-                '   -- analyze move \'{}\' on fen \'{}\''.format(move, fen))
-            last_info = ''
-            if use_engine:
-                self.server.eval_uci('position fen {0}'.format(fen))
-                output = self.server.eval_uci(
-                    'go movetime {}'.format(engine_movetime))
-                for out in output:
-                    if out and 'info' in out and 'score' in out:
-                        last_info = out
-            position = Position(fen, move, last_info)
+        fen_history = chessgame.fen_history
+        last_infos = [None] * len(fen_history)
+
+        # go through fen history and collect engine calculation, in reverse
+        # mode from the last position backwards
+        # positions before the first move out of book are not searched
+        book_plies = self._get_book_plies(fen_history)
+        if self.opening_book:
+            logging.info('-- game #{} follows the book for {} plies'
+                         .format(game_id, book_plies))
+        plies = range(book_plies, len(fen_history))
+        if self.analysis_mode == 'reverse':
+            plies = reversed(plies)
+        if self.analysis_mode == 'triage' and use_engine:
+            last_infos = self._triage_search(
+                engine, game_id, fen_history, moves, engine_movetime,
+                book_plies)
+            plies = []
+        for ply in plies:
+            logging.debug('   -- analyze move \'{}\' on fen \'{}\''.format(
+                moves[ply] if ply < len(moves) else None, fen_history[ply]))
+            if use_engine and self.search_plan:
+                last_infos[ply] = self.search_plan.get_result(
+                    fen_history[ply])
+            elif use_engine:
+                checkpoint_key = '{}/{}'.format(game_id, ply)
+                found, last_infos[ply] = self._get_checkpoint(checkpoint_key)
+                if not found:
+                    infos = self._search_ply(
+                        engine, fen_history, moves, ply, engine_movetime)
+                    if infos:
+                        last_infos[ply] = infos[0]
+                    self._save_checkpoint(checkpoint_key, last_infos[ply])
+        for ply, fen in enumerate(fen_history):
+            move = moves[ply] if ply < len(moves) else None
+            position = Position(fen, move, last_infos[ply])
             positions.append(position)
-            move_idx += 1
+        self._log_search_depth(game_id, last_infos)
 
-        # go reversed through positions and compare/annotate_position
+        # go reversed through positions and compare/annotate_position,
+        # book moves are not annotated
         next_position = None
-        for position in reversed(positions):
-            position.annotate_position(next_position)
-            next_position = position
+        for ply in reversed(range(book_plies, len(positions))):
+            positions[ply].annotate_position(next_position)
+            next_position = positions[ply]
 
         # DEBUG OUTPUT
         debug_headers = []
@@ -294,41 +678,148 @@ class ChessterAnalyzer:
         logging.info('-- game annotation for game #{}:\n{}'.format(game_id,
                                                                    ''.join(game_annotation)))
 
-        ofile = open(path.join(pgn_out_folder,
-                               game_id + '_02_annotated.pgn'), 'w')
-        ofile.write(''.join(game_annotation) + '\n')
-        ofile.close()
-        return ofile.name, positions
-
-    def _extract_fixed_tags(self, pgn_in_file, pgn_out_folder, game_id,
-                            positions, pattern_file):
+        return ''.join(game_annotation) + '\n', positions
+
+    def _search_ply(self, engine, fen_history, moves, ply, engine_movetime):
+        # the engine frontend consults its evaluation cache first
+        self.stats.count('searches')
+        with self.stats.timer('search', 'engine_ms'):
+            if self.analysis_mode == 'reverse':
+                # send the game's moves so the engine keeps the history and
+                # its hash table holds the results of the later positions
+                infos, _ = engine.search(
+                    fen_history[ply], movetime=engine_movetime,
+                    start_fen=fen_history[0], moves=moves[0:ply])
+            else:
+                infos, _ = engine.search(fen_history[ply],
+                                         movetime=engine_movetime)
+        return infos
+
+    def _triage_search(self, engine, game_id, fen_history, moves,
+                       engine_movetime, book_plies=0):
+        start_time = time()
+        last_infos = [None] * book_plies
+        for fen in fen_history[book_plies:]:
+            self.stats.count('searches')
+            with self.stats.timer('search', 'engine_ms'):
+                infos, _ = engine.search(fen, depth=self.triage_depth)
+            last_infos.append(infos[0] if infos else None)
+        # search suspicious moves with full time until the annotations rely
+        # on full-time scores only, a new score can flag neighbouring moves
+        full_plies = set()
+        while True:
+            plies = self._get_triage_plies(
+                fen_history, moves, last_infos, full_plies, book_plies)
+            if not plies:
+                break
+            for ply in plies:
+                logging.debug('   -- re-analyze move \'{}\' on fen \'{}\''
+                              .format(moves[ply] if ply < len(moves) else None,
+                                      fen_history[ply]))
+                infos = self._search_ply(
+                    engine, fen_history, moves, ply, engine_movetime)
+                last_infos[ply] = infos[0] if infos else None
+                full_plies.add(ply)
+        used_ms = (time() - start_time) * 1000.0
+        saved_ms = (len(fen_history) - book_plies) * \
+            float(engine_movetime) - used_ms
+        with self.triage_lock:
+            self.triage_saved_ms += saved_ms
+        logging.info('-- triage searched {}/{} positions of game #{} with '
+                     'full time, saved {:.0f} ms'.format(
+                         len(full_plies), len(fen_history), game_id,
+                         saved_ms))
+        return last_infos
+
+    def _get_triage_plies(self, fen_history, moves, last_infos, full_plies,
+                          book_plies=0):
+        positions = [Position(fen, None, last_info)
+                     for fen, last_info in zip(fen_history, last_infos)]
+        plies = set()
+        for ply in range(book_plies, min(len(moves), len(positions) - 1)):
+            if ply in full_plies and ply + 1 in full_plies:
+                continue
+            if self._is_triage_candidate(positions[ply], positions[ply + 1]):
+                plies.update(set([ply, ply + 1]) - full_plies)
+        return sorted(plies)
+
+    def _is_triage_candidate(self, position, next_position):
+        this_score = position.score_display
+        next_score = next_position.score_display
+        if 'M' in str(this_score) or 'M' in str(next_score):
+            return True
+        if not position.engine_info or not next_position.engine_info:
+            return True
+        score_loss = this_score - next_score if position.white_move \
+            else next_score - this_score
+        return score_loss >= self.triage_threshold
+
+    def _log_search_depth(self, game_id, last_infos):
+        depths = []
+        for last_info in last_infos:
+            if last_info and last_info.depth is not None:
+                depths.append(last_info.depth)
+        self.stats.count('searched_plies', len(depths))
+        self.stats.count('searched_depth', sum(depths))
+        if depths:
+            logging.info('-- game #{} searched to average depth {:.1f} in {} '
+                         'mode'.format(game_id,
+                                       float(sum(depths)) / len(depths),
+                                       self.analysis_mode))
+
+    def _extract_fixed_tags(self, game, game_id, positions, tag_rules):
 
         # read existing tags
-        cmd = ('{} {} -s -e{}'.format(
-            self.server.pgn_extract_path, pgn_in_file,
-            self.server.pgn_extract_eco))
-        p = get_command_process(cmd, stdin=None)
+        if self.use_pgn_extract:
+            tags = self._extract_tags_pgn_extract(game)
+        else:
+            tags = self._extract_tags(game, positions)
         fixed_tags = []
-        for line in p.stdout.readlines():
-            # We need to decode the bytes from stdout when running on python 3
-            if not b_legacy.get_python_major_version() <= 2:
-                line = line.decode()
-            line = line.strip()
+        for line in tags:
             if line and line.startswith('[') and \
                     not line.startswith('[%') and 'Analyze This' not in line:
-                fixed_tags.append(self._fix_tag(line, pattern_file))
+                fixed_tags.append(self._fix_tag(line, tag_rules))
 
         fixed_tags = self._append_chesster_specific_tags(fixed_tags, positions)
         fixed_tags = b_legacy.b_sorted(fixed_tags, cmp=self._compare_tags)
 
-        logging.info('-- writing tags for game #{}'.format(game_id))
-        ofile = open(path.join(pgn_out_folder,
-                               game_id + '_03_tagfix.pgn'), 'w')
+        logging.info('-- fixed tags for game #{}'.format(game_id))
         for fixed_tag in fixed_tags:
             logging.debug('   {}'.format(fixed_tag))
-            ofile.write(fixed_tag + '\n')
-        ofile.close()
-        return ofile.name, fixed_tags
+        return fixed_tags
+
+    def _extract_tags(self, game, positions):
+        # like pgn-extract, always output the seven tag roster
+        tags = []
+        for key in SEVEN_TAG_ROSTER:
+            default = '????.??.??' if key == 'Date' else '?'
+            if key == 'Result':
+                default = game.result
+            tags.append((key, game.get_tag(key, default)))
+        for key, value in game.tags:
+            if key not in SEVEN_TAG_ROSTER:
+                tags.append((key, value))
+        eco_tags = get_eco_classifier(self.server.pgn_extract_eco).classify(
+            [position.fen_string for position in positions])
+        for eco_key, eco_value in eco_tags:
+            tags = [(key, value) for key, value in tags if key != eco_key]
+            tags.append((eco_key, eco_value))
+        return [format_tag(key, value) for key, value in tags]
+
+    def _extract_tags_pgn_extract(self, pgn_in_file):
+        cmd = ('{} {} -s -e{}'.format(
+            self.server.pgn_extract_path, pgn_in_file,
+            self.server.pgn_extract_eco))
+        with self.stats.timer('subprocess', 'subprocess_ms'):
+            p = get_command_process(cmd, stdin=None)
+            stdout_content = p.stdout.readlines()
+        tags = []
+        for line in stdout_content:
+            # We need to decode the bytes from stdout when running on python 3
+            if not b_legacy.get_python_major_version() <= 2:
+                line = line.decode()
+            tags.append(line.strip())
+        return tags
 
     def _append_chesster_specific_tags(self, tags, positions):
         # analysis time
@@ -338,6 +829,8 @@ class ChessterAnalyzer:
         w_bestpos = -1000.0
         b_bestpos = 1000.0
         for position in positions:
+            if not position.engine_info:
+                continue  # not searched, e.g. book positions
             if position.white_move and position.annotation == '?':
                 w_mis += 1
             elif not position.white_move and position.annotation == '?':
@@ -405,56 +898,47 @@ class ChessterAnalyzer:
         except KeyError:
             return 99
 
-    def _load_file_or_none(self, filepath):
+    def _is_readable(self, filepath):
         if not filepath:
-            return None
+            return False
         try:
-            return open(filepath)
+            open(filepath).close()
+            return True
         except IOError:
-            return None
+            return False
 
-    def _load_pattern_file(self, pattern_file):
+    def _load_tag_rules(self, pattern_file):
         logging.info('-- received ext patterns: {}'.format(pattern_file))
         # if external file provided and readable, return first...
-        pattern_fh = self._load_file_or_none(pattern_file)
-        if pattern_fh:
+        if self._is_readable(pattern_file):
             logging.info('-- loading ext patterns from {}'
                          .format(pattern_file))
-            return pattern_fh
+            return get_tag_rules(pattern_file)
         # try to load copy from internal default file...
         pattern_file = path.join(
             self.script_path, 'tag_replace_patterns.properties')
-        pattern_fh = self._load_file_or_none(pattern_file)
-        if pattern_fh:
+        if self._is_readable(pattern_file):
             logging.info('-- loading from-def patterns from {}'
                          .format(pattern_file))
-            return pattern_fh
+            return get_tag_rules(pattern_file)
         # copy from default and load default set
         copy(pattern_file + '.default', pattern_file)
-        pattern_fh = self._load_file_or_none(pattern_file)
-        if pattern_fh:
+        if self._is_readable(pattern_file):
             logging.info('-- loading def patterns from {}'
                          .format(pattern_file))
-            return pattern_fh
+            return get_tag_rules(pattern_file)
         return None
 
-    def _fix_tag(self, tag, pattern_file):
-        pattern_file.seek(0)
-        for pattern_line in pattern_file:
-            pattern_line = pattern_line.strip()
-            search_replace = pattern_line.split('=')
-            if len(search_replace) != 2:
-                continue
-            tag = re.sub(search_replace[0], search_replace[
-                         1], tag, re.IGNORECASE)
+    def _fix_tag(self, tag, tag_rules):
+        if tag_rules:
+            tag = tag_rules.apply(tag)
 
         # Normalize date
         if '[Date' in tag:
             _, value = self._pgn_tag_to_keyvalue(tag)
-            date_obj = parse(value)
-            tag = '[Date "{}.{}.{}]"'.format(
-                date_obj.year, str(date_obj.month).zfill(2),
-                str(date_obj.day).zfill(2))
+            year, month, day = parse_date(value)
+            tag = '[Date "{}.{}.{}"]'.format(
+                year, str(month).zfill(2), str(day).zfill(2))
         return tag
 
     def _filter_move(self, move):
@@ -464,13 +948,29 @@ class ChessterAnalyzer:
             return False
         return True
 
-    def _extract_chessgame(self, pgn_in_file):
-        # get game model
-        chessgame = Game()
+    def _replay_game(self, game_id, game):
+        # a game that cannot be replayed is skipped instead of aborting
+        # the whole run
+        try:
+            with self.stats.timer('replay'):
+                return self._extract_chessgame(game)
+        except (NotationError, ValueError) as e:
+            logging.warning('Skipping game #{}: {}'.format(game_id, e))
+            self.stats.count('skipped_games')
+            return None
+
+    def _extract_chessgame(self, game):
+        if not self.use_pgn_extract:
+            return self._read_chessgame(game)
+        # get game model, games set up from a position start there
+        with open(game) as game_fh:
+            fen = dict(read_tags(game_fh)).get('FEN', DEFAULT_FEN)
+        chessgame = ChessterBoard(fen, validate=True)
         cmd = ('{0} {1} -Wlalg --nomovenumbers --nocomments --nochecks -V --notags -s'
-               .format(self.server.pgn_extract_path, pgn_in_file))
-        p = get_command_process(cmd)
-        stdout_content = p.stdout.readlines()
+               .format(self.server.pgn_extract_path, game))
+        with self.stats.timer('subprocess', 'subprocess_ms'):
+            p = get_command_process(cmd)
+            stdout_content = p.stdout.readlines()
         # We need to decode the bytes from stdout when running on python 3
         if not b_legacy.get_python_major_version() <= 2:
             temp = []
@@ -480,6 +980,9 @@ class ChessterAnalyzer:
         stdout_content = ''.join(stdout_content)
         moves = re.sub('[\r\n]+', ' ', stdout_content)
         moves = b_legacy.b_filter(self._filter_move, moves.split(' '))
+        if not moves:
+            raise NotationError('pgn-extract cannot read game {}'
+                                .format(game))
         result = moves[-1]
         del moves[-1]
         for i in range(0, len(moves)):
@@ -488,3 +991,12 @@ class ChessterAnalyzer:
         comments = {}
         # TODO
         return chessgame, moves, result, comments
+
+    def _read_chessgame(self, game):
+        chessgame = ChessterBoard(game.get_fen() or DEFAULT_FEN)
+        moves = []
+        for san in game.moves:
+            move = san_to_lan(chessgame, san)
+            chessgame.apply_move(move)
+            moves.append(move)
+        return chessgame, moves, game.result, game.comments
@@ -0,0 +1,368 @@
+DEFAULT_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+"""FEN of the initial position"""
+FILES = 'abcdefgh'
+"""File letters from a to h"""
+
+# squares are indexed from a8 (0) to h1 (63) as written in FEN
+_RIGHTS_MAP = {0: 'q', 4: 'kq', 7: 'k', 56: 'Q', 60: 'KQ', 63: 'K'}
+_CASTLING = {
+    # king target: (right, king start, rook start, rook target, squares
+    # that must be empty, squares that must not be attacked)
+    62: ('K', 60, 63, 61, (61, 62), (60, 61, 62)),
+    58: ('Q', 60, 56, 59, (59, 58, 57), (60, 59, 58)),
+    6: ('k', 4, 7, 5, (5, 6), (4, 5, 6)),
+    2: ('q', 4, 0, 3, (3, 2, 1), (4, 3, 2)),
+}
+_PROMOTIONS = 'qrbn'
+_SQUARES = [FILES[idx % 8] + str(8 - idx // 8) for idx in range(64)]
+_INDICES = dict((square, idx) for idx, square in enumerate(_SQUARES))
+# runs of empty squares are collapsed longest first when writing FEN
+_EMPTY_RUNS = [('1' * count, str(count)) for count in range(8, 1, -1)]
+
+
+def square_to_index(square):
+    try:
+        return _INDICES[square]
+    except KeyError:
+        raise ValueError('Invalid square \'{}\'.'.format(square))
+
+
+def index_to_square(idx):
+    return _SQUARES[idx]
+
+
+def _get_rays(offsets, slide):
+    rays_per_square = []
+    for square in range(64):
+        row, col = divmod(square, 8)
+        rays = []
+        for drow, dcol in offsets:
+            ray = []
+            ray_row, ray_col = row + drow, col + dcol
+            while 0 <= ray_row < 8 and 0 <= ray_col < 8:
+                ray.append(ray_row * 8 + ray_col)
+                if not slide:
+                    break
+                ray_row, ray_col = ray_row + drow, ray_col + dcol
+            if ray:
+                rays.append(ray)
+        rays_per_square.append(rays)
+    return rays_per_square
+
+
+_KNIGHT_RAYS = _get_rays([(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2),
+                          (1, 2), (2, -1), (2, 1)], False)
+_KING_RAYS = _get_rays([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1),
+                        (1, -1), (1, 0), (1, 1)], False)
+_BISHOP_RAYS = _get_rays([(-1, -1), (-1, 1), (1, -1), (1, 1)], True)
+_ROOK_RAYS = _get_rays([(-1, 0), (0, -1), (0, 1), (1, 0)], True)
+_PAWN_CAPTURES = {
+    True: [[ray[0] for ray in rays]
+           for rays in _get_rays([(-1, -1), (-1, 1)], False)],
+    False: [[ray[0] for ray in rays]
+            for rays in _get_rays([(1, -1), (1, 1)], False)],
+}
+
+
+def _is_attacked(squares, idx, by_white):
+    """Returns true if a piece of the given color attacks the square."""
+
+    pawn, knight, bishop, rook, queen, king = \
+        'PNBRQK' if by_white else 'pnbrqk'
+    # a pawn attacks the square if a pawn of the other color on the square
+    # could capture it
+    for source in _PAWN_CAPTURES[not by_white][idx]:
+        if squares[source] == pawn:
+            return True
+    for ray in _KNIGHT_RAYS[idx]:
+        if squares[ray[0]] == knight:
+            return True
+    for ray in _KING_RAYS[idx]:
+        if squares[ray[0]] == king:
+            return True
+    for rays, slider in ((_BISHOP_RAYS, bishop), (_ROOK_RAYS, rook)):
+        for ray in rays[idx]:
+            for source in ray:
+                piece = squares[source]
+                if piece:
+                    if piece == slider or piece == queen:
+                        return True
+                    break
+    return False
+
+
+class IllegalMove(ValueError):
+    """Raised if a move cannot be applied to the board"""
+
+
+class ChessterBoard(object):
+    """Compact board to replay LAN moves and build FEN histories without
+    generating all moves of each position. Moves are trusted unless the
+    board validates them. FENs equal those of Chessnut, e.g. the en passant
+    square is set after every double pawn push."""
+
+    __slots__ = ['squares', 'player', 'rights', 'en_passant', 'halfmove',
+                 'fullmove', 'validate', 'fen_history', 'move_history']
+
+    def __init__(self, fen=DEFAULT_FEN, validate=False):
+        self.validate = validate
+        self.fen_history = []
+        self.move_history = []
+        self.set_fen(fen)
+
+    def __str__(self):
+        return self.get_fen()
+
+    def set_fen(self, fen):
+        fields = fen.split()
+        fields.extend(['w', '-', '-', '0', '1'][len(fields) - 1:])
+        squares = []
+        for char in fields[0]:
+            if char.isdigit():
+                squares.extend([None] * int(char))
+            elif char != '/':
+                squares.append(char)
+        if len(squares) != 64:
+            raise ValueError('Invalid FEN \'{}\'.'.format(fen))
+        self.squares = squares
+        self.player = fields[1]
+        self.rights = fields[2]
+        self.en_passant = fields[3]
+        self.halfmove = int(fields[4])
+        self.fullmove = int(fields[5])
+        self.fen_history.append(self.get_fen())
+
+    def get_fen(self):
+        chars = [piece or '1' for piece in self.squares]
+        placement = '/'.join([''.join(chars[row:row + 8])
+                              for row in range(0, 64, 8)])
+        for run, count in _EMPTY_RUNS:
+            placement = placement.replace(run, count)
+        return '{} {} {} {} {} {}'.format(
+            placement, self.player, self.rights, self.en_passant,
+            self.halfmove, self.fullmove)
+
+    def copy(self):
+        """Returns a board with the same position but without history."""
+
+        board = ChessterBoard.__new__(ChessterBoard)
+        board.squares = list(self.squares)
+        board.player = self.player
+        board.rights = self.rights
+        board.en_passant = self.en_passant
+        board.halfmove = self.halfmove
+        board.fullmove = self.fullmove
+        board.validate = self.validate
+        board.fen_history = []
+        board.move_history = []
+        return board
+
+    def get_piece(self, idx):
+        return self.squares[idx]
+
+    def find_piece(self, piece):
+        try:
+            return self.squares.index(piece)
+        except ValueError:
+            return -1
+
+    def is_in_check(self, player=None):
+        """Returns true if the king of the player, by default the player to
+        move, is attacked."""
+
+        white = (player or self.player) == 'w'
+        king = self.find_piece('K' if white else 'k')
+        return king >= 0 and _is_attacked(self.squares, king, not white)
+
+    def is_legal(self, lan):
+        """Returns true if the pseudo-legal move does not leave the moving
+        player's king in check."""
+
+        board = self.copy()
+        board.validate = False
+        board.apply_move(lan)
+        return not board.is_in_check(self.player)
+
+    def get_moves(self, idx_list=None):
+        """Returns the legal moves of the player to move, optionally only
+        those of the pieces on the given squares."""
+
+        return [move for move in self.get_pseudo_moves(idx_list)
+                if self.is_legal(move)]
+
+    def get_origins(self, piece, end):
+        """Returns the squares holding the given piece that can move to the
+        end square, disregarding checks and castling."""
+
+        squares = self.squares
+        white = piece.isupper()
+        kind = piece.upper()
+        target = squares[end]
+        if target and target.isupper() == white:
+            return []
+        if kind == 'P':
+            if target or end == self._get_en_passant_index():
+                return [idx for idx in _PAWN_CAPTURES[not white][end]
+                        if squares[idx] == piece]
+            step = 8 if white else -8
+            origin = end + step
+            if not 0 <= origin < 64:
+                return []
+            if squares[origin] == piece:
+                return [origin]
+            double = origin + step
+            if not squares[origin] and double // 8 == (6 if white else 1) \
+                    and squares[double] == piece:
+                return [double]
+            return []
+        if kind == 'N':
+            return [ray[0] for ray in _KNIGHT_RAYS[end]
+                    if squares[ray[0]] == piece]
+        if kind == 'K':
+            return [ray[0] for ray in _KING_RAYS[end]
+                    if squares[ray[0]] == piece]
+        if kind == 'B':
+            rays = _BISHOP_RAYS[end]
+        elif kind == 'R':
+            rays = _ROOK_RAYS[end]
+        else:
+            rays = _BISHOP_RAYS[end] + _ROOK_RAYS[end]
+        origins = []
+        for ray in rays:
+            for idx in ray:
+                if squares[idx]:
+                    if squares[idx] == piece:
+                        origins.append(idx)
+                    break
+        return origins
+
+    def get_pseudo_moves(self, idx_list=None):
+        """Returns the moves of the player to move without checking whether
+        they leave the own king in check."""
+
+        white = self.player == 'w'
+        moves = []
+        for start in range(64) if idx_list is None else idx_list:
+            piece = self.squares[start]
+            if not piece or piece.isupper() != white:
+                continue
+            kind = piece.upper()
+            if kind == 'P':
+                self._add_pawn_moves(moves, start, white)
+                continue
+            if kind == 'N':
+                rays = _KNIGHT_RAYS[start]
+            elif kind == 'K':
+                rays = _KING_RAYS[start]
+                self._add_castling_moves(moves, start, white)
+            elif kind == 'B':
+                rays = _BISHOP_RAYS[start]
+            elif kind == 'R':
+                rays = _ROOK_RAYS[start]
+            else:
+                rays = _BISHOP_RAYS[start] + _ROOK_RAYS[start]
+            for ray in rays:
+                for end in ray:
+                    target = self.squares[end]
+                    if not target or target.isupper() != white:
+                        moves.append(index_to_square(start) +
+                                     index_to_square(end))
+                    if target:
+                        break
+        return moves
+
+    def apply_move(self, lan):
+        lan = lan.strip().lower()
+        start = _INDICES.get(lan[0:2])
+        end = _INDICES.get(lan[2:4])
+        if start is None or end is None or \
+                (self.validate and lan not in self.get_moves([start])):
+            raise IllegalMove('Illegal move \'{}\' in position \'{}\'.'
+                              .format(lan, self))
+        squares = self.squares
+        piece = squares[start]
+        if not piece:
+            raise IllegalMove('No piece to move for \'{}\' in position '
+                              '\'{}\'.'.format(lan, self))
+        target = squares[end]
+        white = self.player == 'w'
+        pawn = piece in 'Pp'
+        void = _RIGHTS_MAP.get(start, '') + _RIGHTS_MAP.get(end, '')
+        rights = ''.join(right for right in self.rights
+                         if right not in void) or '-'
+        if len(lan) > 4:
+            piece = lan[4].upper() if white else lan[4]
+        squares[end] = piece
+        squares[start] = None
+        # move the rook to the other side of the king in case of castling
+        castling = _CASTLING.get(end)
+        if piece in 'Kk' and castling and start == castling[1] and \
+                castling[0] in self.rights:
+            squares[castling[3]] = squares[castling[2]]
+            squares[castling[2]] = None
+        # in en passant remove the pawn that is captured
+        if pawn and self._get_en_passant_index() == end:
+            squares[end + 8 if end < 24 else end - 8] = None
+        self.en_passant = index_to_square((start + end) // 2) \
+            if pawn and abs(start - end) == 16 else '-'
+        self.halfmove = 0 if pawn or target else self.halfmove + 1
+        if not white:
+            self.fullmove += 1
+        self.player = 'b' if white else 'w'
+        self.rights = rights
+        self.move_history.append(lan)
+        self.fen_history.append(self.get_fen())
+
+    def get_string_board(self):
+        """Returns the board as text, black pieces in lower case."""
+
+        lines = ['\n', '    a b c d e f g h\n', '  /-----------------\\\n']
+        for row in range(8):
+            lines.append('{0} |'.format(8 - row))
+            for piece in self.squares[row * 8:row * 8 + 8]:
+                lines.append(' ' + piece if piece else ' _')
+            lines.append(' |{0}\n'.format(8 - row))
+        lines.extend(['  \\-----------------/\n', '    a b c d e f g h\n',
+                      '\n'])
+        return ''.join(lines)
+
+    def _add_pawn_moves(self, moves, start, white):
+        squares = self.squares
+        step = -8 if white else 8
+        origin = index_to_square(start)
+        ends = []
+        end = start + step
+        if 0 <= end < 64 and not squares[end]:
+            ends.append(end)
+            home_row = 6 if white else 1
+            if start // 8 == home_row and not squares[end + step]:
+                ends.append(end + step)
+        en_passant = self._get_en_passant_index()
+        for end in _PAWN_CAPTURES[white][start]:
+            target = squares[end]
+            if (target and target.isupper() != white) or end == en_passant:
+                ends.append(end)
+        for end in ends:
+            move = origin + index_to_square(end)
+            if end < 8 or end >= 56:
+                moves.extend(move + promotion for promotion in _PROMOTIONS)
+            else:
+                moves.append(move)
+
+    def _get_en_passant_index(self):
+        return _INDICES.get(self.en_passant)
+
+    def _add_castling_moves(self, moves, start, white):
+        for end, (right, king_start, rook_start, _, empty, safe) in \
+                _CASTLING.items():
+            if start != king_start or right not in self.rights or \
+                    right.isupper() != white:
+                continue
+            if self.squares[rook_start] != ('R' if white else 'r'):
+                continue
+            if any(self.squares[idx] for idx in empty):
+                continue
+            if any(_is_attacked(self.squares, idx, not white)
+                   for idx in safe):
+                continue
+            moves.append(index_to_square(start) + index_to_square(end))
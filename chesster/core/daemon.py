@@ -1,9 +1,11 @@
 import logging
 from multiprocessing import cpu_count
-from os import path, listdir
+from os import path
 from chesster.core.uci_frontend import ChessterUciFrontend
 from chesster.core.analyzer import ChessterAnalyzer
-from bptbx.b_iotools import read_file_to_list, write_list_to_file
+from chesster.core.eval_cache import ChessterEvalCache
+from chesster.core.watcher import ChessterFolderWatcher, \
+    ChessterProcessedIndex, has_tag
 from bptbx.b_daemon import Daemon
 
 
@@ -12,48 +14,81 @@ class ChessterDaemon(Daemon):
     workdir = None
     log_filepath = None
     time_to_think = 5000
+    cache_file = None
+    watcher = None
+    """Reports new or changed files in the working directory"""
+    processed_index = None
+    """Files processed before, loaded once from the log file"""
+    retry_files = None
+    """Files whose analysis failed or did not run, retried on the next run
+    as the watcher reports them only once"""
     options = {
         'setoption name Hash value 32',
         'setoption name Threads value {}'.format(cpu_count()),
         'setoption name Skill Level value 20',
     }
 
-    def configure_daemon(self, workdir, time_to_think, pattern_file):
+    def configure_daemon(self, workdir, time_to_think, pattern_file,
+                         cache_file=None):
         self.workdir = path.abspath(workdir)
         self.log_filepath = path.join(workdir, '.chesster_server')
         self.time_to_think = time_to_think
         self.pattern_file = pattern_file
+        self.cache_file = cache_file
 
     def _run_daemon_process(self):
-        logging.info('========== ChessterDaemon started processing')
-        chesster_server = ChessterUciFrontend()
-        chesster_server.init_engine(self.options)
-        for name in listdir(self.workdir):
-            already_processed = read_file_to_list(self.log_filepath, True)
-            file_path = path.join(self.workdir, name)
-            if path.isdir(file_path) or not file_path.endswith('.pgn'):
+        if not self.watcher:
+            self.watcher = ChessterFolderWatcher(self.workdir)
+            self.processed_index = ChessterProcessedIndex(self.log_filepath)
+            self.retry_files = []
+        changed_files = self.retry_files + [
+            file_path for file_path in self.watcher.get_changed_files()
+            if file_path not in self.retry_files]
+        pending = []
+        for file_path in changed_files:
+            if not path.isfile(file_path):
                 continue
-            if file_path in already_processed:
-                logging.info(
+            if file_path in self.processed_index:
+                logging.debug(
                     'File \'{}\' processed before according to log list.'
                     .format(file_path))
                 continue
-            content = read_file_to_list(file_path)
-            tag_found = False
-            for line in content:
-                if 'ChessterAnalysisTs' in line:
-                    logging.info(
-                        'File \'{}\' processed before according to tags.'
-                        .format(file_path))
-                    tag_found = True
-            if tag_found:
+            if has_tag(file_path, 'ChessterAnalysisTs'):
+                logging.info(
+                    'File \'{}\' processed before according to tags.'
+                    .format(file_path))
+                self.processed_index.add(file_path)
                 continue
-            chesster_analyzer = ChessterAnalyzer(chesster_server)
-            chesster_analyzer.analyze(
-                file_path, self.workdir, self.time_to_think, False, False,
-                self.pattern_file)
-            already_processed.append(file_path)
-            write_list_to_file(already_processed, self.log_filepath)
+            pending.append(file_path)
+        # files are removed once analyzed, so files not reached because the
+        # engine failed are retried as well
+        self.retry_files = list(pending)
+        if not pending:
+            return
 
-        chesster_server.shutdown()
+        logging.info('========== ChessterDaemon started processing')
+        eval_cache = ChessterEvalCache(self.cache_file)
+        chesster_server = ChessterUciFrontend(cache=eval_cache)
+        try:
+            chesster_server.init_engine(self.options)
+            for file_path in pending:
+                # remember the file as it was before the analysis started
+                signature = self.processed_index.get_signature(file_path)
+                if not signature:
+                    self.retry_files.remove(file_path)
+                    continue
+                try:
+                    chesster_analyzer = ChessterAnalyzer(chesster_server)
+                    chesster_analyzer.analyze(
+                        file_path, self.workdir, self.time_to_think, False,
+                        False, self.pattern_file)
+                except Exception as e:
+                    logging.error('Analysis of \'{}\' failed, retrying on '
+                                  'the next run: {}'.format(file_path, e))
+                    continue
+                self.processed_index.add(file_path, signature)
+                self.retry_files.remove(file_path)
+        finally:
+            chesster_server.shutdown()
+            eval_cache.close()
         logging.info('========== ChessterDaemon finished processing')
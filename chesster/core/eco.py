@@ -0,0 +1,76 @@
+import logging
+from threading import Lock
+from chesster.core.board import ChessterBoard
+from chesster.core.pgn import read_games
+from chesster.core.notation import san_to_lan, NotationError
+
+ECO_TAGS = ['ECO', 'Opening', 'Variation', 'SubVariation']
+"""Tags set by an ECO classification"""
+PLY_TOLERANCE = 6
+"""Allowed difference in half moves between a game and a matching ECO line"""
+
+_classifiers = {}
+_classifiers_lock = Lock()
+
+
+def get_position_key(fen_string):
+    """Returns the part of a FEN that identifies a position for opening
+    classification, i.e. piece placement and player to move."""
+
+    return ' '.join(fen_string.split(' ')[0:2])
+
+
+def get_eco_classifier(eco_file):
+    """Returns the classifier for an ECO file. Classifiers are loaded once
+    and shared afterwards."""
+
+    with _classifiers_lock:
+        if eco_file not in _classifiers:
+            _classifiers[eco_file] = ChessterEcoClassifier(eco_file)
+        return _classifiers[eco_file]
+
+
+class ChessterEcoClassifier:
+    """In-process ECO classification based on pgn-extract's eco.pgn"""
+
+    positions = None
+    """Maps position keys to the ECO line's length and ECO tags"""
+
+    def __init__(self, eco_file):
+        self.positions = {}
+        logging.info('-- loading ECO classification from {}'.format(eco_file))
+        with open(eco_file) as eco_fh:
+            for eco_game in read_games(eco_fh):
+                self._add_line(eco_game)
+        logging.info('-- loaded {} ECO positions'.format(len(self.positions)))
+
+    def classify(self, fen_history):
+        """Returns the ECO tags as (key, value) pairs for the deepest ECO line
+        matching a position of the game within the ply tolerance."""
+
+        best_plies = -1
+        best_tags = []
+        for ply, fen_string in enumerate(fen_history):
+            entry = self.positions.get(get_position_key(fen_string))
+            if not entry:
+                continue
+            plies, tags = entry
+            if abs(plies - ply) <= PLY_TOLERANCE and plies > best_plies:
+                best_plies = plies
+                best_tags = tags
+        return list(best_tags)
+
+    def _add_line(self, eco_game):
+        tags = [(key, value) for key, value in eco_game.tags
+                if key in ECO_TAGS]
+        chessgame = ChessterBoard()
+        try:
+            for san in eco_game.moves:
+                chessgame.apply_move(san_to_lan(chessgame, san))
+        except NotationError as e:
+            logging.warning('Skipping ECO line {}: {}'.format(tags, e))
+            return
+        key = get_position_key(chessgame.get_fen())
+        # keep the first classification of a position like pgn-extract
+        if key not in self.positions:
+            self.positions[key] = (len(eco_game.moves), tags)
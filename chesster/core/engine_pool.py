@@ -0,0 +1,157 @@
+import logging
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from threading import Thread, Lock
+from chesster.core.uci_frontend import ChessterUciFrontend
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+
+
+class ChessterPoolBusy(Exception):
+    """Raised if no engine of the pool becomes available in time or too many
+    callers are already waiting for one"""
+
+
+class ChessterEnginePool:
+    """A pool of UCI engine processes to work on several jobs in parallel"""
+
+    engines = None
+    """All engine frontends managed by this pool"""
+    threads = 1
+    """Number of search threads per engine"""
+    hash_mb = 32
+    """Hash table size per engine in MB"""
+    max_waiting = None
+    """Maximum number of callers waiting in acquire (None for no limit)"""
+
+    def __init__(self, size, threads=None, hash_mb=32, options=None,
+                 timeout=None, cache=None, max_waiting=None):
+        size = max(1, int(size))
+        if threads is None:
+            # share the available cores between the engines
+            threads = max(1, cpu_count() // size)
+        self.threads = max(1, int(threads))
+        self.hash_mb = max(1, int(hash_mb))
+        logging.info('-- starting {} engines with {} threads and {} MB hash'
+                     .format(size, self.threads, self.hash_mb))
+        self.max_waiting = max_waiting
+        self.engines = []
+        self._idle = Queue()
+        self._waiting = 0
+        self._waiting_lock = Lock()
+        for _ in range(size):
+            engine = ChessterUciFrontend(timeout, cache)
+            engine.init_engine(self._get_engine_options(options))
+            self.engines.append(engine)
+            self._idle.put(engine)
+
+    def size(self):
+        return len(self.engines)
+
+    def idle(self):
+        return self._idle.qsize()
+
+    def waiting(self):
+        return self._waiting
+
+    def acquire(self, timeout=None):
+        """Returns an idle engine for exclusive use until it is released.
+        Waits up to timeout seconds for an engine and raises ChessterPoolBusy
+        if none becomes available or max_waiting callers already wait. Do not
+        mix with map, which uses all engines regardless."""
+
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._waiting_lock:
+            if self.max_waiting is not None and \
+                    self._waiting >= self.max_waiting:
+                raise ChessterPoolBusy(
+                    'All engines busy and {} requests waiting.'
+                    .format(self._waiting))
+            self._waiting += 1
+        try:
+            return self._idle.get(timeout=timeout)
+        except Empty:
+            raise ChessterPoolBusy('No engine available within {} s.'
+                                   .format(timeout))
+        finally:
+            with self._waiting_lock:
+                self._waiting -= 1
+
+    def release(self, engine):
+        self._idle.put(engine)
+
+    @contextmanager
+    def engine(self, timeout=None):
+        """Acquires an engine for the enclosed block."""
+
+        engine = self.acquire(timeout)
+        try:
+            yield engine
+        finally:
+            self.release(engine)
+
+    def map(self, function, items):
+        """Calls function(engine, item) for all items, each on the next free
+        engine, and returns the results in the order of the given items.
+        Items are consumed lazily, so generators are not read ahead by more
+        than two items per engine."""
+
+        results = {}
+        errors = []
+        jobs = Queue(maxsize=2 * len(self.engines))
+
+        def work(engine):
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                if errors:
+                    continue
+                idx, item = job
+                try:
+                    results[idx] = function(engine, item)
+                except Exception as e:
+                    logging.error('Job #{} failed: {}'.format(idx, e))
+                    errors.append(e)
+
+        workers = []
+        for engine in self.engines:
+            worker = Thread(target=work, args=(engine,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        item_count = 0
+        try:
+            for item in items:
+                if errors:
+                    break
+                jobs.put((item_count, item))
+                item_count += 1
+        finally:
+            for _ in workers:
+                jobs.put(None)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return [results[idx] for idx in range(item_count)]
+
+    def shutdown(self):
+        for engine in self.engines:
+            engine.shutdown()
+
+    def _get_engine_options(self, options):
+        engine_options = [
+            'setoption name Hash value {}'.format(self.hash_mb),
+            'setoption name Threads value {}'.format(self.threads),
+            'setoption name Skill Level value 20',
+        ]
+        for option in options or []:
+            if option not in engine_options:
+                engine_options.append(option)
+        return engine_options
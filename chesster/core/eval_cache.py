@@ -0,0 +1,160 @@
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+from time import time
+
+
+def normalize_fen(fen_string):
+    """Returns the FEN without move clocks and with normalized whitespace,
+    so that equal positions share one cache entry."""
+
+    return ' '.join(fen_string.split()[0:4])
+
+
+class ChessterEvalCache:
+    """Two-level cache for engine evaluations. Entries are kept in an
+    in-memory LRU in front of an optional SQLite database."""
+
+    db_path = None
+    """Path to SQLite database or None for an in-memory cache only"""
+    memory_size = 10000
+    """Maximum number of entries in the in-memory LRU"""
+    disk_size = 1000000
+    """Maximum number of entries in the SQLite database"""
+    hits = 0
+    """Number of lookups answered by the cache"""
+    disk_hits = 0
+    """Number of lookups answered by the SQLite database"""
+    misses = 0
+    """Number of lookups that required an engine search"""
+    commit_interval = 100
+    """Number of database writes after which they are committed"""
+
+    def __init__(self, db_path=None, memory_size=10000, disk_size=1000000):
+        self.db_path = db_path
+        self.memory_size = max(1, int(memory_size))
+        self.disk_size = max(1, int(disk_size))
+        self.hits = self.disk_hits = self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = Lock()
+        self._db = None
+        self._disk_count = 0
+        self._pending_writes = 0
+        if db_path:
+            self._open_db()
+
+    def get_key(self, fen_string, engine_id, options, limit):
+        """Returns the cache key for a search on the given position with the
+        given engine, engine options and search limit."""
+
+        key = '|'.join([
+            normalize_fen(fen_string), str(engine_id),
+            ';'.join(sorted('{}={}'.format(name, value)
+                            for name, value in options.items())),
+            str(limit)])
+        return sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached evaluation for the key or None."""
+
+        with self._lock:
+            value = self._memory.pop(key, None)
+            if value is None and self._db:
+                value = self._get_from_db(key)
+                if value is not None:
+                    self.disk_hits += 1
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._put_to_memory(key, value)
+            return value
+
+    def put(self, key, value):
+        """Stores an evaluation, i.e. a dictionary of JSON-serializable
+        values, under the given key."""
+
+        with self._lock:
+            self._memory.pop(key, None)
+            self._put_to_memory(key, value)
+            if self._db:
+                self._put_to_db(key, value)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+            'disk_entries': self._disk_count,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+        logging.info('-- evaluation cache stats: {}'.format(self.get_stats()))
+
+    def _put_to_memory(self, key, value):
+        self._memory[key] = value
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _open_db(self):
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS evaluations ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'last_used REAL NOT NULL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS evaluations_last_used '
+            'ON evaluations (last_used)')
+        self._db.commit()
+        self._disk_count = self._db.execute(
+            'SELECT COUNT(*) FROM evaluations').fetchone()[0]
+        logging.info('-- opened evaluation cache {} with {} entries'
+                     .format(self.db_path, self._disk_count))
+
+    def _get_from_db(self, key):
+        row = self._db.execute('SELECT value FROM evaluations WHERE key = ?',
+                               (key,)).fetchone()
+        if not row:
+            return None
+        self._db.execute('UPDATE evaluations SET last_used = ? WHERE key = ?',
+                         (time(), key))
+        return json.loads(row[0])
+
+    def _put_to_db(self, key, value):
+        exists = self._db.execute('SELECT 1 FROM evaluations WHERE key = ?',
+                                  (key,)).fetchone()
+        self._db.execute(
+            'INSERT OR REPLACE INTO evaluations (key, value, last_used) '
+            'VALUES (?, ?, ?)', (key, json.dumps(value), time()))
+        if not exists:
+            self._disk_count += 1
+        if self._disk_count > self.disk_size:
+            self._evict_from_db()
+        # commit in batches, a commit per evaluation is too expensive
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_interval:
+            self._db.commit()
+            self._pending_writes = 0
+
+    def _evict_from_db(self):
+        # evict the least recently used tenth at once to amortize the cost
+        evict_count = self._disk_count - self.disk_size + \
+            max(1, self.disk_size // 10)
+        self._db.execute(
+            'DELETE FROM evaluations WHERE key IN (SELECT key FROM evaluations '
+            'ORDER BY last_used ASC LIMIT ?)', (evict_count,))
+        self._disk_count = self._db.execute(
+            'SELECT COUNT(*) FROM evaluations').fetchone()[0]
+        logging.debug('-- evicted {} evaluations from cache'
+                      .format(evict_count))
@@ -1,5 +1,6 @@
 import logging
-from os import path
+import sys
+from os import path, environ
 from bptbx.b_cmdline import get_platform, check_for_command
 
 
@@ -8,6 +9,13 @@ def _get_basedir():
 
 
 def get_stockfish_path():
+    # CHESSTER_ENGINE selects another engine binary or 'fake' for the
+    # deterministic stand-in engine
+    engine = environ.get('CHESSTER_ENGINE')
+    if engine == 'fake':
+        return get_fake_engine_path()
+    elif engine:
+        return engine
     sys_platform = get_platform()
     if 'windows' in sys_platform:
         return path.join(_get_basedir(), 'stockfish', 'stockfish-7-x64-win.exe')
@@ -23,6 +31,12 @@ def get_stockfish_path():
         exit(1)
 
 
+def get_fake_engine_path():
+    # run with the current interpreter which has chesster's dependencies
+    fake_engine = path.join(_get_basedir(), 'core', 'fake_engine.py')
+    return '"{}" "{}"'.format(sys.executable, fake_engine)
+
+
 def get_pgn_extract_path():
 
     sys_platform = get_platform()
@@ -32,9 +46,10 @@ def get_pgn_extract_path():
     elif 'linux' in sys_platform:
         is_available = check_for_command('pgn-extract', ['--version'])
         if not is_available:
-            logging.error('pgn-extract not present. ' +
-                          'You need to install pgn-extract first!')
-            exit(1)
+            # pgn-extract is an optional backend, the built-in PGN reader
+            # is used by default
+            logging.debug('pgn-extract not present.')
+            return None
         return 'pgn-extract'
     return None
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""A deterministic stand-in for a UCI engine to run chesster without
+Stockfish. Select it by setting the environment variable CHESSTER_ENGINE to
+'fake'. The engine is configured through environment variables:
+
+CHESSTER_FAKE_LATENCY   Time per search in ms or 'movetime' to use the
+                        search's movetime (default: 0).
+CHESSTER_FAKE_DEPTH     Depth reported for searches without depth limit
+                        (default: 12).
+CHESSTER_FAKE_PV        Length of the principal variations (default: 3).
+CHESSTER_FAKE_SCORES    JSON file mapping FENs (first four fields) to a
+                        line or a list of lines (one per multipv), e.g.
+                        {"score": "cp 35", "pv": "e2e4 e7e5"}.
+
+Positions not listed in the scores file get a score and legal moves derived
+from a hash of the position, so every run returns the same results."""
+
+import json
+import sys
+import time
+from hashlib import sha1
+from os import environ
+from threading import Thread
+from Chessnut import Game
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+
+ENGINE_NAME = 'Chesster Fake Engine'
+"""Name reported on 'uci'"""
+GO_FLAGS = ['ponder', 'infinite']
+"""Arguments of 'go' without value"""
+GO_VALUES = ['depth', 'movetime', 'wtime', 'btime', 'winc', 'binc',
+             'movestogo', 'nodes', 'mate']
+"""Arguments of 'go' followed by a value"""
+
+
+def normalize_fen(fen_string):
+    return ' '.join(fen_string.split(' ')[0:4])
+
+
+def parse_go_args(tokens):
+    """Returns the arguments of a 'go' command as a dictionary. Flags map to
+    True, other arguments to their value. Unknown tokens, e.g. the moves of
+    'searchmoves', are skipped."""
+
+    args = {}
+    idx = 0
+    while idx < len(tokens):
+        token = tokens[idx]
+        if token in GO_FLAGS:
+            args[token] = True
+        elif token in GO_VALUES and idx + 1 < len(tokens) and \
+                tokens[idx + 1] not in GO_FLAGS + GO_VALUES:
+            idx += 1
+            args[token] = tokens[idx]
+        idx += 1
+    return args
+
+
+def get_position_number(fen_string, salt=''):
+    """Returns a stable number for a position."""
+
+    digest = sha1((normalize_fen(fen_string) + salt).encode('utf-8'))
+    return int(digest.hexdigest()[0:8], 16)
+
+
+class FakeEngine:
+    """Answers UCI commands read from stdin on stdout"""
+
+    def __init__(self, latency='0', depth=12, pv_length=3, scores=None):
+        self.latency = latency
+        self.depth = depth
+        self.pv_length = pv_length
+        self.scores = scores or {}
+        self.multipv = 1
+        self.fen = Game.default_fen
+        self.commands = Queue()
+        self._moves = {}
+
+    def run(self):
+        reader = Thread(target=self._read_commands)
+        reader.daemon = True
+        reader.start()
+        while True:
+            command = self.commands.get()
+            if command is None or command == 'quit':
+                break
+            self._handle_command(command)
+
+    def _read_commands(self):
+        for line in iter(sys.stdin.readline, ''):
+            if line.strip():
+                self.commands.put(line.strip())
+        self.commands.put(None)
+
+    def _handle_command(self, command):
+        tokens = command.split()
+        if tokens[0] == 'uci':
+            self._send('id name {}'.format(ENGINE_NAME))
+            self._send('id author chesster')
+            self._send('option name MultiPV type spin default 1 min 1 max 500')
+            self._send('option name Ponder type check default false')
+            self._send('uciok')
+        elif tokens[0] == 'isready':
+            self._send('readyok')
+        elif tokens[0] == 'ucinewgame':
+            self.fen = Game.default_fen
+        elif tokens[0] == 'setoption':
+            self._set_option(command)
+        elif tokens[0] == 'position':
+            self._set_position(tokens[1:])
+        elif tokens[0] == 'go':
+            self._search(tokens[1:])
+
+    def _set_option(self, command):
+        if command.lower().startswith('setoption name multipv value '):
+            self.multipv = max(1, int(command.split()[-1]))
+
+    def _set_position(self, tokens):
+        if tokens[0] == 'startpos':
+            fen = Game.default_fen
+            moves_idx = 1
+        else:
+            moves_idx = tokens.index('moves') if 'moves' in tokens \
+                else len(tokens)
+            fen = ' '.join(tokens[1:moves_idx])
+        chessgame = Game(fen=fen, validate=False)
+        for move in tokens[moves_idx + 1:]:
+            chessgame.apply_move(move)
+        self.fen = chessgame.get_fen()
+
+    def _search(self, tokens):
+        args = parse_go_args(tokens)
+        depth = int(args.get('depth', self.depth))
+        infinite = args.get('infinite', False)
+        ponder = args.get('ponder', False)
+        lines = self._get_lines(self.fen)
+        wait = self._get_latency(args.get('movetime'))
+        start = time.time()
+        for current_depth in range(1, depth + 1):
+            # spread the search time over the reported depths
+            if not (infinite or ponder) and self._wait(wait / depth):
+                break
+            for multipv, line in enumerate(lines):
+                self._send_info(current_depth, multipv + 1, line)
+        if infinite:
+            self._wait(None)
+        elif ponder and self._wait(None) == 'ponderhit':
+            # continue as timed search, the time counts from 'go'
+            self._wait(max(0.0, wait - (time.time() - start)))
+        pv = lines[0]['pv'] if lines else []
+        best_move = 'bestmove {}'.format(pv[0] if pv else '(none)')
+        if len(pv) > 1:
+            best_move += ' ponder {}'.format(pv[1])
+        self._send(best_move)
+
+    def _wait(self, seconds):
+        """Waits for the given time or until a search is stopped. Other
+        commands are answered in the meantime. Returns the command that
+        stopped the search or False."""
+
+        deadline = None if seconds is None else time.time() + seconds
+        while True:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                command = self.commands.get(timeout=remaining)
+            except Empty:
+                return False
+            if command is None or command in ('stop', 'ponderhit', 'quit'):
+                if command is None or command == 'quit':
+                    self.commands.put(command)
+                return command or 'quit'
+            self._handle_command(command)
+
+    def _get_latency(self, movetime):
+        if self.latency == 'movetime':
+            return float(movetime or 0) / 1000.0
+        return float(self.latency) / 1000.0
+
+    def _send_info(self, depth, multipv, line):
+        info = 'info depth {} seldepth {} multipv {} score {} nodes {} ' \
+            'nps 1000000 time {}'.format(depth, depth + 2, multipv,
+                                         line['score'], depth * 1000, depth)
+        if line['pv']:
+            info += ' pv ' + ' '.join(line['pv'])
+        self._send(info)
+
+    def _get_lines(self, fen_string):
+        configured = self.scores.get(normalize_fen(fen_string))
+        if configured:
+            if isinstance(configured, dict):
+                configured = [configured]
+            lines = []
+            for line in configured[0:self.multipv]:
+                pv = line.get('pv', [])
+                if not isinstance(pv, list):
+                    pv = pv.split()
+                lines.append({'score': line.get('score', 'cp 0'), 'pv': pv})
+            return lines
+        moves = self._get_moves(fen_string)
+        if not moves:
+            chessgame = Game(fen=fen_string)
+            score = 'mate 0' if chessgame.status == Game.CHECKMATE \
+                else 'cp 0'
+            return [{'score': score, 'pv': []}]
+        number = get_position_number(fen_string)
+        lines = []
+        for multipv in range(min(self.multipv, len(moves))):
+            move = moves[(number + multipv) % len(moves)]
+            score = number % 201 - 100 - 15 * multipv
+            lines.append({'score': 'cp {}'.format(score),
+                          'pv': self._get_pv(fen_string, move)})
+        return lines
+
+    def _get_pv(self, fen_string, move):
+        pv = [move]
+        chessgame = Game(fen=fen_string, validate=False)
+        while len(pv) < self.pv_length:
+            chessgame.apply_move(pv[-1])
+            moves = self._get_moves(chessgame.get_fen())
+            if not moves:
+                break
+            pv.append(moves[get_position_number(chessgame.get_fen())
+                            % len(moves)])
+        return pv
+
+    def _get_moves(self, fen_string):
+        if fen_string not in self._moves:
+            self._moves[fen_string] = sorted(Game(fen=fen_string).get_moves())
+        return self._moves[fen_string]
+
+    def _send(self, line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def main():
+    scores = {}
+    scores_file = environ.get('CHESSTER_FAKE_SCORES')
+    if scores_file:
+        with open(scores_file) as ifile:
+            scores = dict((normalize_fen(fen), line) for fen, line
+                          in json.load(ifile).items())
+    FakeEngine(environ.get('CHESSTER_FAKE_LATENCY', '0'),
+               int(environ.get('CHESSTER_FAKE_DEPTH', 12)),
+               int(environ.get('CHESSTER_FAKE_PV', 3)), scores).run()
+
+
+if __name__ == '__main__':
+    main()
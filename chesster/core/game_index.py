@@ -0,0 +1,184 @@
+import io
+import logging
+import mmap
+from fnmatch import fnmatchcase
+from os import path, rename
+from bptbx.b_iotools import remove_silent
+from chesster.core.pgn import read_games, read_game_ranges
+
+INDEX_SUFFIX = '.games'
+"""Suffix of game index files stored next to the PGN files"""
+INDEX_HEADER = 'chesster-game-index 1'
+"""First line of a game index, followed by the size of the PGN file"""
+
+
+class ChessterGameSelection:
+    """Games to analyze out of a PGN file, given by ranges of game numbers,
+    e.g. '1-10,25,100-', and by tag filters, e.g. 'White=Carlsen*'. A game
+    is selected if it lies in one of the ranges, if any, and matches all
+    tag filters."""
+
+    id_ranges = None
+    """List of (first, last) game numbers, last is None for open ranges"""
+    tag_filters = None
+    """List of (lower case tag key, lower case shell-style pattern)"""
+
+    def __init__(self, id_ranges=None, tag_filters=None):
+        self.id_ranges = []
+        for id_range in (id_ranges or '').split(','):
+            id_range = id_range.strip()
+            if id_range:
+                self.id_ranges.append(_parse_id_range(id_range))
+        self.tag_filters = []
+        for tag_filter in tag_filters or []:
+            key, separator, pattern = tag_filter.partition('=')
+            if not separator or not key.strip():
+                raise ValueError('Invalid tag filter \'{}\', expected '
+                                 '<TAG>=<PATTERN>.'.format(tag_filter))
+            self.tag_filters.append((key.strip().lower(), pattern.lower()))
+
+    def get_last(self):
+        """Returns the highest selected game number or None if unlimited."""
+
+        if not self.id_ranges or any(last is None
+                                     for _, last in self.id_ranges):
+            return None
+        return max(last for _, last in self.id_ranges)
+
+    def matches_id(self, game_number):
+        if not self.id_ranges:
+            return True
+        for first, last in self.id_ranges:
+            if first <= game_number and (last is None or game_number <= last):
+                return True
+        return False
+
+    def matches_tags(self, tags):
+        if not self.tag_filters:
+            return True
+        tags = dict((key.lower(), value.lower()) for key, value in tags)
+        for key, pattern in self.tag_filters:
+            if key not in tags or not fnmatchcase(tags[key], pattern):
+                return False
+        return True
+
+
+class ChessterGameIndex:
+    """Index of the byte range, tags and number of plies of each game of a
+    PGN file. The index is built once by scanning the memory-mapped file,
+    stored next to it with one line per game and rebuilt when the file
+    changes. Selected games are parsed from their byte ranges only."""
+
+    pgn_file = None
+    """Indexed PGN file"""
+    index_file = None
+    """Path to the index file"""
+    games = 0
+    """Number of games in the index"""
+
+    def __init__(self, pgn_file):
+        self.pgn_file = pgn_file
+        self.index_file = pgn_file + INDEX_SUFFIX
+        self._pgn_fh = open(pgn_file, 'rb')
+        self._mmap = None
+        if path.getsize(pgn_file) > 0:
+            self._mmap = mmap.mmap(self._pgn_fh.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        if not self._is_index_valid():
+            self._write_index()
+        with io.open(self.index_file, encoding='utf-8') as ifile:
+            self.games = sum(1 for _ in ifile) - 1
+
+    def select(self, selection):
+        """Yields (game number, offset, length, plies, tags) of the selected
+        games in file order, game numbers start at 1."""
+
+        last = selection.get_last()
+        with io.open(self.index_file, encoding='utf-8') as ifile:
+            next(ifile)
+            for game_number, line in enumerate(ifile, 1):
+                if last is not None and game_number > last:
+                    return
+                if not selection.matches_id(game_number):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                tags = list(zip(fields[3::2], fields[4::2]))
+                if not selection.matches_tags(tags):
+                    continue
+                yield (game_number, int(fields[0]), int(fields[1]),
+                       int(fields[2]), tags)
+
+    def read_game(self, offset, length):
+        """Parses the game stored in the given byte range."""
+
+        content = _decode(self._mmap[offset:offset + length])
+        return next(read_games(content.splitlines(True)), None)
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._pgn_fh.close()
+
+    def _is_index_valid(self):
+        if not path.exists(self.index_file) or \
+                path.getmtime(self.index_file) < path.getmtime(self.pgn_file):
+            return False
+        with io.open(self.index_file, encoding='utf-8') as ifile:
+            header = ifile.readline().rstrip('\n')
+        return header == '{} {}'.format(INDEX_HEADER,
+                                        path.getsize(self.pgn_file))
+
+    def _write_index(self):
+        logging.info('-- building game index for {}'.format(self.pgn_file))
+        games = 0
+        # write to a temporary file first so readers never see partial files
+        with io.open(self.index_file + '.tmp', 'w',
+                     encoding='utf-8') as ofile:
+            ofile.write(u'{} {}\n'.format(INDEX_HEADER,
+                                          path.getsize(self.pgn_file)))
+            for start, end, game in read_game_ranges(self._read_lines()):
+                fields = [str(start), str(end - start), str(len(game.moves))]
+                for key, value in game.tags:
+                    fields.extend([_escape(key), _escape(value)])
+                ofile.write(u'\t'.join(fields) + u'\n')
+                games += 1
+        remove_silent(self.index_file)
+        rename(self.index_file + '.tmp', self.index_file)
+        logging.info('-- indexed {} games'.format(games))
+
+    def _read_lines(self):
+        if not self._mmap:
+            return
+        self._mmap.seek(0)
+        start = 0
+        while True:
+            line = self._mmap.readline()
+            if not line:
+                return
+            end = self._mmap.tell()
+            yield start, end, _decode(line)
+            start = end
+
+
+def _parse_id_range(id_range):
+    try:
+        if '-' not in id_range:
+            return int(id_range), int(id_range)
+        first, last = id_range.split('-', 1)
+        return int(first or 1), int(last) if last.strip() else None
+    except ValueError:
+        raise ValueError('Invalid game range \'{}\', expected e.g. '
+                         '\'1-10,25,100-\'.'.format(id_range))
+
+
+def _decode(content):
+    # large databases are often written in Latin-1
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('latin-1')
+
+
+def _escape(text):
+    # tabs and line breaks separate the fields and games of the index
+    return text.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
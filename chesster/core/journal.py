@@ -0,0 +1,112 @@
+import json
+import logging
+from os import path
+from threading import Lock
+from bptbx.b_iotools import remove_silent
+from chesster.core.uci_info import parse_info
+
+
+class ChessterJournal:
+    """Checkpoint journal of an analysis run. Finished games and optionally
+    the engine result of every searched position are appended as JSON
+    lines, so an interrupted run with the same input and settings resumes
+    where it stopped. Each line is flushed when written."""
+
+    journal_file = None
+    """Path to the journal file"""
+    run = None
+    """Input file signature and settings the journal is valid for"""
+    games = None
+    """Maps the game id to the final PGN and tags of finished games"""
+    results = None
+    """Maps search keys to the info line of the best result or None"""
+
+    def __init__(self, journal_file, run):
+        self.journal_file = journal_file
+        self.run = run
+        self.games = {}
+        self.results = {}
+        self._lock = Lock()
+        self._incomplete = False
+        new_journal = not self._load()
+        self._fh = open(journal_file, 'w' if new_journal else 'a')
+        if new_journal:
+            self._append({'run': run})
+        else:
+            if self._incomplete:
+                self._fh.write('\n')
+            logging.info('-- resuming from {}: {} finished games, {} '
+                         'searched positions'.format(
+                             journal_file, len(self.games),
+                             len(self.results)))
+
+    def get_game(self, game_id):
+        """Returns (final PGN file, tags) of a finished game or None, if
+        the game or its file is missing."""
+
+        game = self.games.get(game_id)
+        if not game or not path.exists(game[0]):
+            return None
+        return game
+
+    def add_game(self, game_id, file_fin, tags):
+        self.games[game_id] = (file_fin, tags)
+        self._append({'game': game_id, 'file': file_fin, 'tags': tags})
+
+    def has_result(self, key):
+        return key in self.results
+
+    def get_result(self, key):
+        """Returns the info record stored for the search key or None."""
+
+        line = self.results.get(key)
+        return parse_info(line) if line else None
+
+    def add_result(self, key, info):
+        line = str(info) if info else None
+        self.results[key] = line
+        self._append({'result': key, 'info': line})
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def remove(self):
+        """Closes and deletes the journal once the run is complete."""
+
+        self.close()
+        remove_silent(self.journal_file)
+
+    def _append(self, record):
+        with self._lock:
+            # parallel games may still finish after an interrupted run
+            # closed the journal
+            if self._fh.closed:
+                return
+            self._fh.write(json.dumps(record, sort_keys=True) + '\n')
+            self._fh.flush()
+
+    def _load(self):
+        # returns true if the journal exists and belongs to the same run
+        if not path.exists(self.journal_file):
+            return False
+        records = []
+        with open(self.journal_file) as ifile:
+            for line in ifile:
+                # the last line is incomplete if the run was killed while
+                # writing it
+                self._incomplete = not line.endswith('\n')
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        if not records or records[0].get('run') != self.run:
+            logging.info('-- journal {} belongs to another run, starting '
+                         'over'.format(self.journal_file))
+            return False
+        for record in records[1:]:
+            if 'game' in record:
+                self.games[record['game']] = (record['file'], record['tags'])
+            elif 'result' in record:
+                self.results[record['result']] = record['info']
+        return True
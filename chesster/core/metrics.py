@@ -0,0 +1,118 @@
+from threading import Lock
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0]
+"""Upper bounds in seconds of the latency histogram buckets"""
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""Content type of the Prometheus text exposition format"""
+
+
+def _format_labels(label_key, extra=None):
+    labels = list(label_key)
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class ChessterMetrics:
+    """Thread-safe registry of counters, gauges and histograms that renders
+    in the Prometheus text exposition format. The type of a metric is set by
+    the method used first, i.e. inc for counters, set for gauges and observe
+    for histograms."""
+
+    buckets = None
+    """Upper bounds of the histogram buckets"""
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or DEFAULT_BUCKETS)
+        self._lock = Lock()
+        self._metrics = {}
+        self._order = []
+
+    def describe(self, name, metric_type, help_text):
+        with self._lock:
+            self._get_metric(name, metric_type)['help'] = help_text
+
+    def inc(self, name, value=1, labels=None):
+        with self._lock:
+            values = self._get_metric(name, 'counter')['values']
+            key = self._get_label_key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def dec(self, name, value=1, labels=None):
+        with self._lock:
+            values = self._get_metric(name, 'gauge')['values']
+            key = self._get_label_key(labels)
+            values[key] = values.get(key, 0) - value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            values = self._get_metric(name, 'gauge')['values']
+            values[self._get_label_key(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        with self._lock:
+            values = self._get_metric(name, 'histogram')['values']
+            key = self._get_label_key(labels)
+            if key not in values:
+                values[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = values[key]
+            for idx, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[0][idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+
+        lines = []
+        with self._lock:
+            for name in self._order:
+                metric = self._metrics[name]
+                if metric['help']:
+                    lines.append('# HELP {} {}'.format(name, metric['help']))
+                lines.append('# TYPE {} {}'.format(name, metric['type']))
+                for key in sorted(metric['values']):
+                    value = metric['values'][key]
+                    if metric['type'] == 'histogram':
+                        lines.extend(self._render_histogram(name, key, value))
+                    else:
+                        lines.append('{}{} {}'.format(
+                            name, _format_labels(key), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, name, key, histogram):
+        lines = []
+        bucket_counts, total, count = histogram
+        for bucket, bucket_count in zip(self.buckets + [float('inf')],
+                                        bucket_counts + [count]):
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(key, ('le', _format_value(
+                    float(bucket)))), bucket_count))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(key),
+                                          _format_value(total)))
+        lines.append('{}_count{} {}'.format(name, _format_labels(key), count))
+        return lines
+
+    def _get_metric(self, name, metric_type):
+        if name not in self._metrics:
+            self._metrics[name] = {'type': metric_type, 'help': None,
+                                   'values': {}}
+            self._order.append(name)
+        return self._metrics[name]
+
+    def _get_label_key(self, labels):
+        return tuple(sorted((labels or {}).items()))
@@ -0,0 +1,132 @@
+import re
+from chesster.core.board import ChessterBoard, square_to_index, \
+    index_to_square
+
+_SAN_PATTERN = re.compile(
+    '^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQnbrq]))?$')
+_CASTLING = {
+    ('w', 'O-O'): 'e1g1', ('w', 'O-O-O'): 'e1c1',
+    ('b', 'O-O'): 'e8g8', ('b', 'O-O-O'): 'e8c8',
+}
+
+
+class NotationError(Exception):
+    """Raised if a move cannot be converted between notations"""
+
+
+def san_to_lan(chessgame, san):
+    """Returns the long algebraic notation, e.g. 'g1f3', of a move given in
+    standard algebraic notation, e.g. 'Nf3', for the current position of the
+    board (a ChessterBoard or a Chessnut game)."""
+
+    board = _get_board(chessgame)
+    player = board.player
+    san = re.sub('[+#!?]+$', '', san.strip()).replace('0', 'O')
+    if san in ('O-O', 'O-O-O'):
+        return _CASTLING[(player, san)]
+    match_ob = _SAN_PATTERN.match(san)
+    if not match_ob:
+        raise NotationError('Invalid move \'{}\'.'.format(san))
+    piece, from_file, from_rank, target, promotion = match_ob.groups()
+    piece = piece or 'P'
+    piece = piece if player == 'w' else piece.lower()
+    end = square_to_index(target)
+    # pawns must promote on the last rank and only there
+    if (piece in 'Pp' and end // 8 in (0, 7)) != bool(promotion):
+        raise NotationError('Move \'{}\' is illegal in position \'{}\'.'
+                            .format(san, board))
+    candidates = []
+    for idx in board.get_origins(piece, end):
+        square = index_to_square(idx)
+        if from_file and square[0] != from_file:
+            continue
+        if from_rank and square[1] != from_rank:
+            continue
+        candidates.append(square + target +
+                          (promotion.lower() if promotion else ''))
+    if len(candidates) > 1:
+        candidates = [move for move in candidates if board.is_legal(move)]
+    if len(candidates) != 1:
+        raise NotationError('Move \'{}\' is {} in position \'{}\'.'.format(
+            san, 'ambiguous' if candidates else 'illegal', board))
+    return candidates[0]
+
+
+def lan_to_san(chessgame, lan):
+    """Returns the standard algebraic notation of a move given in long
+    algebraic notation for the current position of the board (a
+    ChessterBoard or a Chessnut game)."""
+
+    board = _get_board(chessgame)
+    lan = lan.strip().lower()
+    start = square_to_index(lan[0:2])
+    end = square_to_index(lan[2:4])
+    piece = board.squares[start]
+    if not piece:
+        raise NotationError('No piece to move for \'{}\' in \'{}\'.'
+                            .format(lan, board))
+    capture = board.squares[end] is not None
+    if piece.lower() == 'k' and abs(start - end) == 2:
+        san = 'O-O' if end > start else 'O-O-O'
+    elif piece.lower() == 'p':
+        san = ''
+        if lan[0] != lan[2]:
+            san = lan[0] + 'x'
+        san += lan[2:4]
+        if len(lan) > 4:
+            san += '=' + lan[4].upper()
+    else:
+        san = piece.upper() + _get_disambiguation(board, lan, piece) + \
+            ('x' if capture else '') + lan[2:4]
+    return san + _get_check_suffix(board, lan)
+
+
+def replay_lan_moves(fen_string, lan_moves):
+    """Returns the SAN moves for a line of LAN moves starting at the given
+    position. The line is cut at the first move that cannot be played."""
+
+    board = ChessterBoard(fen_string)
+    san_moves = []
+    for lan in lan_moves:
+        try:
+            san_moves.append(lan_to_san(board, lan))
+            board.apply_move(lan)
+        except (NotationError, ValueError, IndexError):
+            break
+    return san_moves
+
+
+def is_in_check(chessgame, player=None):
+    """Returns true if the king of the player, by default the player to
+    move, is attacked."""
+
+    return _get_board(chessgame).is_in_check(player)
+
+
+def _get_board(chessgame):
+    if isinstance(chessgame, ChessterBoard):
+        return chessgame
+    return ChessterBoard(str(chessgame))
+
+
+def _get_disambiguation(board, lan, piece):
+    rivals = [index_to_square(idx) + lan[2:4]
+              for idx in board.get_origins(piece, square_to_index(lan[2:4]))
+              if index_to_square(idx) != lan[0:2]]
+    rivals = [move for move in rivals if board.is_legal(move)]
+    if not rivals:
+        return ''
+    if all(move[0] != lan[0] for move in rivals):
+        return lan[0]
+    if all(move[1] != lan[1] for move in rivals):
+        return lan[1]
+    return lan[0:2]
+
+
+def _get_check_suffix(board, lan):
+    test_board = board.copy()
+    test_board.validate = False
+    test_board.apply_move(lan)
+    if not test_board.is_in_check():
+        return ''
+    return '+' if test_board.get_moves() else '#'
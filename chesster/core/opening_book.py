@@ -0,0 +1,116 @@
+import logging
+import mmap
+from hashlib import sha1
+from os import path, rename
+from chesster.core.board import ChessterBoard
+from bptbx.b_iotools import remove_silent
+from chesster.core import externals
+from chesster.core.eval_cache import normalize_fen
+from chesster.core.notation import san_to_lan, NotationError
+from chesster.core.pgn import read_games
+
+HASH_SIZE = 8
+"""Number of bytes of a position hash in the index"""
+INDEX_SUFFIX = '.idx'
+"""Suffix of index files stored next to the book files"""
+
+
+def get_position_hash(fen_string):
+    """Returns the hash of a position as stored in the book index."""
+
+    return sha1(normalize_fen(fen_string).encode('utf-8')).digest()[
+        0:HASH_SIZE]
+
+
+class ChessterOpeningBook:
+    """Index of all positions of opening book lines. Each book PGN gets a
+    sorted index of position hashes next to it, which is rebuilt when the
+    book changes and memory-mapped for lookups."""
+
+    book_files = None
+    """PGN files with the book lines, pgn-extract's eco.pgn by default"""
+
+    def __init__(self, book_files=None):
+        self.book_files = [externals.get_pgn_extract_opening_book()]
+        self.book_files.extend(book_files or [])
+        self._indices = []
+        for book_file in self.book_files:
+            self._indices.append(self._load_index(book_file))
+
+    def __contains__(self, fen_string):
+        position_hash = get_position_hash(fen_string)
+        for index in self._indices:
+            if self._index_contains(index, position_hash):
+                return True
+        return False
+
+    def get_book_plies(self, fen_history):
+        """Returns the number of leading moves of a game, given by its FEN
+        history, that lead into book positions."""
+
+        book_plies = 0
+        for fen_string in fen_history[1:]:
+            if fen_string not in self:
+                break
+            book_plies += 1
+        return book_plies
+
+    def close(self):
+        for index in self._indices:
+            if isinstance(index, mmap.mmap):
+                index.close()
+        self._indices = []
+
+    def _load_index(self, book_file):
+        index_file = book_file + INDEX_SUFFIX
+        if not path.exists(index_file) or \
+                path.getmtime(index_file) < path.getmtime(book_file):
+            hashes = self._build_index(book_file)
+            try:
+                self._write_index(index_file, hashes)
+            except (IOError, OSError) as e:
+                logging.warning('Cannot write book index {}: {}'
+                                .format(index_file, e))
+                return b''.join(hashes)
+        with open(index_file, 'rb') as ifile:
+            if path.getsize(index_file) == 0:
+                return b''
+            return mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _build_index(self, book_file):
+        logging.info('-- building book index for {}'.format(book_file))
+        hashes = set()
+        with open(book_file) as ifile:
+            for book_game in read_games(ifile):
+                chessgame = ChessterBoard()
+                hashes.add(get_position_hash(chessgame.get_fen()))
+                try:
+                    for san in book_game.moves:
+                        chessgame.apply_move(san_to_lan(chessgame, san))
+                        hashes.add(get_position_hash(chessgame.get_fen()))
+                except NotationError as e:
+                    logging.warning('Skipping rest of book line: {}'
+                                    .format(e))
+        logging.info('-- indexed {} book positions'.format(len(hashes)))
+        return sorted(hashes)
+
+    def _write_index(self, index_file, hashes):
+        # write to a temporary file first so readers never see partial files
+        with open(index_file + '.tmp', 'wb') as ofile:
+            ofile.write(b''.join(hashes))
+        remove_silent(index_file)
+        rename(index_file + '.tmp', index_file)
+
+    def _index_contains(self, index, position_hash):
+        low = 0
+        high = len(index) // HASH_SIZE
+        while low < high:
+            middle = (low + high) // 2
+            entry = index[middle * HASH_SIZE:(middle + 1) * HASH_SIZE]
+            if entry < position_hash:
+                low = middle + 1
+            elif entry > position_hash:
+                high = middle
+            else:
+                return True
+        return False
@@ -0,0 +1,356 @@
+import re
+
+RESULTS = ['1-0', '0-1', '1/2-1/2', '*']
+"""Valid game termination markers"""
+SEVEN_TAG_ROSTER = ['Event', 'Site', 'Date', 'Round', 'White', 'Black',
+                    'Result']
+"""Tags that every exported game contains"""
+EXPORT_TAG_ORDER = SEVEN_TAG_ROSTER + [
+    'WhiteTitle', 'BlackTitle', 'WhiteElo', 'BlackElo', 'WhiteUSCF',
+    'BlackUSCF', 'WhiteType', 'BlackType', 'WhiteNA', 'BlackNA', 'ECO', 'NIC',
+    'Opening', 'Variation', 'SubVariation', 'LongECO', 'TimeControl',
+    'Annotator', 'EventDate', 'EventSponsor', 'Section', 'Stage', 'Board',
+    'Time', 'UTCDate', 'UTCTime', 'SetUp', 'FEN', 'Termination', 'Mode',
+    'PlyCount', 'Elo', 'FENPattern', 'HashCode', 'Player', 'TotalPlyCount']
+"""Order of known tags in exported games as written by pgn-extract, other
+tags follow in their input order"""
+LINE_LENGTH = 75
+"""Maximum line length of exported movetext"""
+NAGS = {'!': 1, '?': 2, '!!': 3, '??': 4, '!?': 5, '?!': 6}
+"""Maps move suffix annotations to numeric annotation glyphs"""
+
+_TAG_PATTERN = re.compile('^\\s*\\[\\s*(\\w+)\\s+"(.*)"\\s*\\]\\s*$')
+_LOOSE_TAG_PATTERN = re.compile('^\\s*\\[\\s*(\\w+)\\s*(.*?)\\s*$')
+_TOKEN_PATTERN = re.compile(
+    '(\\{)|(;.*)|(\\()|(\\))|(\\$[0-9]+)|([0-9]+\\.+)|([^\\s{}();$]+)')
+_MOVE_SUFFIX_PATTERN = re.compile('[!?]+$')
+
+
+class PgnGame:
+    """A single game as read from a PGN file"""
+
+    tags = None
+    """Ordered list of (key, value) tag pairs"""
+    moves = None
+    """Moves of the main line in SAN"""
+    comments = None
+    """Maps the number of moves played to the comment following them"""
+    nags = None
+    """Maps the number of moves played to the annotation glyphs of the
+    last move"""
+    result = None
+    """Game termination marker"""
+
+    def __init__(self):
+        self.tags = []
+        self.moves = []
+        self.comments = {}
+        self.nags = {}
+        self.result = '*'
+
+    def get_tag(self, key, default=None):
+        for tag_key, value in self.tags:
+            if tag_key.lower() == key.lower():
+                return value
+        return default
+
+    def set_tag(self, key, value):
+        for idx, (tag_key, _) in enumerate(self.tags):
+            if tag_key.lower() == key.lower():
+                self.tags[idx] = (tag_key, value)
+                return
+        self.tags.append((key, value))
+
+    def get_fen(self):
+        """Returns the start position of a game set up from a position, as
+        given by its FEN tag, or None for the standard start position."""
+
+        return self.get_tag('FEN')
+
+    def is_empty(self):
+        return not self.tags and not self.moves
+
+
+def read_games(pgn_file):
+    """Lazily yields all games of an open PGN file as PgnGame objects. Only
+    the game currently read is held in memory. Variations are skipped."""
+
+    reader = _PgnReader()
+    for line in pgn_file:
+        for game in reader.feed(line):
+            yield game
+    game = reader.finish()
+    if game:
+        yield game
+
+
+def read_game_ranges(pgn_lines):
+    """Lazily yields (start, end, game) for all games of an iterable of
+    (start, end, line) tuples, e.g. lines with their byte offsets. A game's
+    range spans from the end of the previous game to the end of its result,
+    so parsing the range alone returns the game."""
+
+    reader = _PgnReader()
+    start = end = 0
+    for line_start, end, line in pgn_lines:
+        for game in reader.feed(line):
+            # a tag line that completes a game without result belongs to
+            # the next game
+            game_end = line_start if reader.game.tags else end
+            yield start, game_end, game
+            start = game_end
+    game = reader.finish()
+    if game:
+        yield start, end, game
+
+
+def read_tags(pgn_file):
+    """Yields the (key, value) tag pairs of the first game of an open PGN
+    file. Reading stops at the first line of movetext. Malformed tag lines
+    are returned with their raw value."""
+
+    in_tags = False
+    for line in pgn_file:
+        if line.startswith('%') or (not line.strip() and not in_tags):
+            continue
+        match_ob = _TAG_PATTERN.match(line)
+        if match_ob:
+            yield match_ob.group(1), re.sub('\\\\(["\\\\])', '\\1',
+                                            match_ob.group(2))
+        else:
+            match_ob = _LOOSE_TAG_PATTERN.match(line)
+            if not match_ob:
+                return
+            yield match_ob.group(1), match_ob.group(2)
+        in_tags = True
+
+
+def format_tag(key, value):
+    """Returns a PGN tag line for the given key and value."""
+
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '[{} "{}"]'.format(key, value)
+
+
+def format_game(tags, movetext_tokens, line_length=LINE_LENGTH):
+    """Returns a game in PGN export format like pgn-extract writes it. Tags
+    are given as PGN tag lines, the movetext as a list of tokens that are
+    wrapped to the line length. The game ends with an empty line."""
+
+    lines = sort_tags(tags)
+    lines.append('')
+    lines.extend(wrap_tokens(movetext_tokens, line_length))
+    lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+def sort_tags(tags):
+    """Returns PGN tag lines in export order."""
+
+    def get_rank(tag):
+        match_ob = _LOOSE_TAG_PATTERN.match(tag)
+        if match_ob and match_ob.group(1) in EXPORT_TAG_ORDER:
+            return EXPORT_TAG_ORDER.index(match_ob.group(1))
+        return len(EXPORT_TAG_ORDER)
+
+    # the sort is stable, so unknown tags keep their order
+    return sorted(tags, key=get_rank)
+
+
+def wrap_tokens(tokens, line_length=LINE_LENGTH):
+    """Wraps movetext tokens to lines like pgn-extract. Tokens are separated
+    by spaces, except after an opening and before a closing parenthesis."""
+
+    lines = []
+    line = ''
+    attach = False
+    for token in tokens:
+        if attach or token == ')':
+            fits = len(line) + len(token) <= line_length
+            separator = ''
+        else:
+            fits = len(line) + 1 + len(token) <= line_length
+            separator = ' ' if line else ''
+        if not fits and line:
+            lines.append(line)
+            line = ''
+            separator = ''
+        line = line + separator + token
+        attach = token == '('
+    if line:
+        lines.append(line)
+    return lines
+
+
+def format_pgn_game(game):
+    """Returns a PgnGame in PGN export format."""
+
+    tags = [format_tag(key, value) for key, value in game.tags]
+    move_number, white_move = get_fen_move(game.get_fen() or '')
+    return format_game(tags, get_movetext_tokens(
+        game.moves, game.result, game.nags, game.comments,
+        move_number=move_number, white_move=white_move))
+
+
+def get_movetext_tokens(san_moves, result=None, nags=None, comments=None,
+                        variations=None, move_number=1, white_move=True):
+    """Returns the movetext tokens for a line of SAN moves. Glyphs, comments
+    and lists of variations (lists of SAN moves replacing the last move) are
+    given as dictionaries mapping the number of moves played to the entries
+    following them."""
+
+    nags = nags or {}
+    comments = comments or {}
+    variations = variations or {}
+    tokens = []
+    force_number = True
+    if 0 in comments:
+        tokens.extend(_get_comment_tokens(comments[0]))
+    for idx, san in enumerate(san_moves):
+        move_number_token = get_move_number_token(
+            move_number, white_move, force_number)
+        if move_number_token:
+            tokens.append(move_number_token)
+        tokens.append(san)
+        force_number = False
+        for nag in nags.get(idx + 1, []):
+            tokens.append('${}'.format(nag))
+        if idx + 1 in comments:
+            tokens.extend(_get_comment_tokens(comments[idx + 1]))
+            force_number = True
+        for variation in variations.get(idx + 1, []):
+            variation_tokens = get_movetext_tokens(
+                variation, move_number=move_number, white_move=white_move)
+            if not variation_tokens:
+                continue
+            tokens.append('(')
+            tokens.extend(variation_tokens)
+            tokens.append(')')
+            force_number = True
+        if not white_move:
+            move_number += 1
+        white_move = not white_move
+    if result:
+        tokens.append(result)
+    return tokens
+
+
+def get_move_number_token(move_number, white_move, force=False):
+    """Returns the move number token for a move or None, if the move does
+    not need a move number."""
+
+    if white_move:
+        return '{}.'.format(move_number)
+    if force:
+        return '{}...'.format(move_number)
+    return None
+
+
+def get_fen_move(fen_string):
+    """Returns (move number, white to move) of the position given as FEN.
+    Missing fields default to the first move of white."""
+
+    fields = fen_string.split()
+    white_move = len(fields) < 2 or fields[1] != 'b'
+    move_number = 1
+    if len(fields) > 5 and fields[5].isdigit():
+        move_number = int(fields[5])
+    return move_number, white_move
+
+
+def _get_comment_tokens(comment):
+    return ['{'] + comment.split() + ['}']
+
+
+class _PgnReader:
+    """Incremental PGN parser that is fed line by line"""
+
+    def __init__(self):
+        self.game = PgnGame()
+        self.in_movetext = False
+        self.comment = None
+        self.depth = 0
+
+    def feed(self, line):
+        games = []
+        if self.comment is None and self.depth == 0:
+            if line.startswith('%'):
+                return games
+            match_ob = _TAG_PATTERN.match(line)
+            if match_ob:
+                if self.in_movetext:
+                    # a new tag section starts although no result was found
+                    games.append(self._complete())
+                value = re.sub('\\\\(["\\\\])', '\\1', match_ob.group(2))
+                self.game.tags.append((match_ob.group(1), value))
+                return games
+        position = 0
+        if self.comment is not None:
+            position = self._read_comment(line, 0)
+        while position is not None and position < len(line):
+            match_ob = _TOKEN_PATTERN.search(line, position)
+            if not match_ob:
+                break
+            position = match_ob.end()
+            if match_ob.group(1):
+                self.comment = []
+                position = self._read_comment(line, position)
+            elif match_ob.group(3):
+                self.depth += 1
+            elif match_ob.group(4):
+                self.depth = max(0, self.depth - 1)
+            elif self.depth > 0 or match_ob.group(2):
+                continue
+            elif match_ob.group(5):
+                self._add_nag(int(match_ob.group(5)[1:]))
+            elif match_ob.group(7):
+                if self._add_token(match_ob.group(7)):
+                    games.append(self._complete())
+        return games
+
+    def finish(self):
+        if self.game.is_empty():
+            return None
+        return self._complete()
+
+    def _read_comment(self, line, position):
+        end = line.find('}', position)
+        if end < 0:
+            self.comment.append(line[position:].strip())
+            return None
+        self.comment.append(line[position:end].strip())
+        if self.depth == 0:
+            comment = ' '.join(filter(None, self.comment))
+            ply = len(self.game.moves)
+            if ply in self.game.comments:
+                comment = self.game.comments[ply] + ' ' + comment
+            self.game.comments[ply] = comment
+        self.comment = None
+        return end + 1
+
+    def _add_nag(self, nag):
+        self.in_movetext = True
+        self.game.nags.setdefault(len(self.game.moves), []).append(nag)
+
+    def _add_token(self, token):
+        self.in_movetext = True
+        if token in RESULTS:
+            self.game.result = token
+            return True
+        suffix = _MOVE_SUFFIX_PATTERN.search(token)
+        if suffix:
+            token = token[:suffix.start()]
+        if not token:
+            return False
+        self.game.moves.append(token)
+        if suffix and suffix.group() in NAGS:
+            self._add_nag(NAGS[suffix.group()])
+        return False
+
+    def _complete(self):
+        game = self.game
+        self.game = PgnGame()
+        self.in_movetext = False
+        self.depth = 0
+        self.comment = None
+        return game
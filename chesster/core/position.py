@@ -1,4 +1,6 @@
 import re
+from chesster.core.board import ChessterBoard
+from chesster.core.uci_info import InfoRecord, parse_info
 
 class Position:
     
@@ -18,8 +20,11 @@ class Position:
         self.fen_string = str(fen_string)
         if move_played is not None:
             self.move_played = str(move_played)
-        if engine_info is not None:
-            self.engine_info = str(engine_info)
+        if engine_info is not None and not isinstance(engine_info,
+                                                      InfoRecord):
+            engine_info = parse_info(str(engine_info))
+        if engine_info is not None and engine_info.has_score():
+            self.engine_info = engine_info
         self._extract_information()
     
     def annotate_position(self, next_position):
@@ -52,27 +57,7 @@ class Position:
                                                     next_position.score_display)
             
     def fen_to_string_board(self):
-        unicode_board = []
-        unicode_board.append('\n')
-        unicode_board.append('    a b c d e f g h\n')
-        unicode_board.append('  /-----------------\\\n')
-        row_count = 8
-        positions = self.fen_string.split(' ')[0]
-        for row in positions.split('/'):
-            unicode_board.append('{0} |'.format(row_count),)
-            for col in row:
-                try: 
-                    col_int = int(col)
-                    for _ in range(col_int):
-                        unicode_board.append(' _',)
-                except ValueError:
-                    unicode_board.append(' ' + col)
-            unicode_board.append(' |{0}\n'.format(row_count))
-            row_count -= 1
-        unicode_board.append('  \-----------------/\n')
-        unicode_board.append('    a b c d e f g h\n')
-        unicode_board.append('\n')
-        return ''.join(unicode_board)
+        return ChessterBoard(self.fen_string).get_string_board()
 
     def get_debug_string(self):
         player = 'White'
@@ -103,12 +88,10 @@ class Position:
         if self.engine_info is None:
             return
         # get position score 
-        self.score_original = self._get_engine_info_or_none(
-                'score[ ]+(cp|mate)[ ]+-?\d+[ ]?(lowerbound|upperbound)?')
+        self.score_original = self.engine_info.get_score_string()
         self._convert_original_score()
         # get best line 
-        self.best_line = self._get_engine_info_or_none(
-                                            ' pv([ ]+[abcdefgh12345678]+)+')
+        self.best_line = self.engine_info.get_pv_string()
         
     def _get_score_change(self, this_score, next_score):
         if 'M' in str(this_score) or 'M' in str(next_score):
@@ -121,8 +104,8 @@ class Position:
         return next_score - this_score 
     
     def _convert_original_score(self):
-        score_type = self.score_original.split(' ')[0].strip()
-        score_num = float(self.score_original.split(' ')[1].strip())
+        score_type = self.engine_info.score_type
+        score_num = float(self.engine_info.score_value)
         if score_type == 'mate':
             if not self.white_move:
                 score_num = -1.0 * score_num
@@ -132,11 +115,3 @@ class Position:
             if not self.white_move and int(score_num) != 0: 
                 score_num = -1.0 * score_num
             self.score_display = score_num / 100.0        
-
-    def _get_engine_info_or_none(self, pattern):
-        match_ob = re.search(pattern, self.engine_info, re.IGNORECASE)
-        if not match_ob:
-            return None
-        info = match_ob.group()
-        info = re.sub('^[ ]*[^\s]+ ', '', info)  # remove the info key 
-        return info
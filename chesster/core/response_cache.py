@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from time import time
+
+
+class _Flight:
+    """A computation in progress that concurrent requests wait for"""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.expires = None
+        self.error = None
+
+
+class ChessterResponseCache:
+    """Time-limited LRU cache of server responses. Concurrent lookups of a
+    key that is not cached share a single computation (single flight)."""
+
+    ttl = 60.0
+    """Seconds a response is cached or 0 to only share computations"""
+    size = 10000
+    """Maximum number of cached responses"""
+    hits = 0
+    """Number of lookups answered by the cache"""
+    coalesced = 0
+    """Number of lookups that waited for the computation of another one"""
+    misses = 0
+    """Number of lookups that required a computation"""
+
+    def __init__(self, ttl=60.0, size=10000):
+        self.ttl = max(0.0, float(ttl))
+        self.size = max(1, int(size))
+        self.hits = self.coalesced = self.misses = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = Lock()
+
+    def get(self, key, compute):
+        """Returns the value cached for the key and the time it expires (None
+        if it is not cached). Otherwise compute() is called, which returns
+        the value and whether it may be cached. Lookups of the key arriving
+        during the computation wait for it and get its value or error."""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > time():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, flight.expires
+        try:
+            value, cacheable = compute()
+            flight.value = value
+            if cacheable and self.ttl > 0:
+                flight.expires = time() + self.ttl
+            return flight.value, flight.expires
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.expires is not None:
+                    self._put(key, (flight.value, flight.expires))
+            flight.done.set()
+
+    def get_stats(self):
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits + self.coalesced) / lookups
+            if lookups else 0.0,
+            'entries': len(self._entries),
+        }
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
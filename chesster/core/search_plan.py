@@ -0,0 +1,45 @@
+from collections import OrderedDict
+from chesster.core.zobrist import get_zobrist_key
+
+
+class ChessterSearchPlan:
+    """Positions of all games of an analysis run keyed by their Zobrist
+    hash, so each unique position is searched once and its result is shared
+    by every game reaching it"""
+
+    positions = None
+    """Maps position keys to the FEN of the first occurrence"""
+    results = None
+    """Maps position keys to the best info record of the search"""
+    total = 0
+    """Number of positions added, including repeated ones"""
+
+    def __init__(self):
+        self.positions = OrderedDict()
+        self.results = {}
+        self.total = 0
+
+    def add(self, fen_string):
+        self.total += 1
+        key = get_zobrist_key(fen_string)
+        if key not in self.positions:
+            self.positions[key] = fen_string
+
+    def get_unique_positions(self):
+        """Returns (key, FEN) of all unique positions in order of their
+        first occurrence."""
+
+        return list(self.positions.items())
+
+    def set_result(self, key, info):
+        self.results[key] = info
+
+    def get_result(self, fen_string):
+        return self.results.get(get_zobrist_key(fen_string))
+
+    def get_dedup_ratio(self):
+        """Returns the share of positions that need no search of their own."""
+
+        if not self.total:
+            return 0.0
+        return 1.0 - float(len(self.positions)) / self.total
@@ -1,55 +1,518 @@
-import logging
-from re import sub
-from bottle import request, abort, response, route, run
-from chesster.core.uci_frontend import ChessterUciFrontend
-
-class ChessterServer:
-
-    uci_frontend = ChessterUciFrontend()
-    """Frontend for accessing UCI-engine and PGN-extract"""
-
-    def __init__(self, host, port):
-        logging.info('Obtained new server instance.')
-        self.uci_frontend.init_engine()
-        route('/')(self.bottle_get)
-        route('/uci')(self.bottle_get_eval_uci)
-        route('/bestmove')(self.bottle_get_bestmove)
-        route('/evalpos')(self.bottle_get_eval_position)
-        logging.info('Routed default webservice endpoints.')
-        run(host=host, port=port)
-
-    def bottle_get(self):
-        return self._bottle_generate_response({ 'chesster in online'},
-                                              request, response)
-
-    def bottle_get_eval_uci(self):
-        uci_string = request.query.com
-        if uci_string is None or uci_string == '':
-            abort(400, text='Obligatory parameter \'com\' missing.')
-        output = self.uci_frontend.eval_uci(uci_string)
-        return self._bottle_generate_response(output, request, response)
-
-    def bottle_get_bestmove(self):
-        fen_string = request.query.fen
-        ttm = request.query.ttm
-        if not fen_string:
-            abort(400, text='Obligatory parameter \'fen\' missing.')
-        best_move = self.uci_frontend.bestmove(fen_string, ttm)
-        return self._bottle_generate_response(best_move,
-                                       request, response)
-
-    def bottle_get_eval_position(self):
-        fen_string = request.query.fen
-        ttm = request.query.ttm
-        if not fen_string:
-            abort(400, text='Obligatory parameter \'fen\' missing.')
-        evaluation = self.uci_frontend.eval_position(fen_string, ttm)
-        return self._bottle_generate_response(evaluation,
-                                       request, response)
-
-    def _bottle_generate_response(self, output, request, response):
-        response.add_header('Content-Type', 'text/html; charset=utf-8')
-        content = ('<html><style>* {{font-family:Consolas;}}</style><body>'
-        + '{0}</body></html>'.format('<br/>'.join(output)))
-        content = sub('\n', '<br/>', content)
-        return content
+import json
+import logging
+from hashlib import sha1
+from re import sub
+from threading import Event, Thread
+from time import time
+from types import GeneratorType
+from timeit import default_timer
+from wsgiref.simple_server import make_server, WSGIServer, \
+    WSGIRequestHandler
+from bottle import request, abort, response, route, run, HTTPResponse, \
+    HTTPError, ServerAdapter
+from chesster.core.engine_pool import ChessterEnginePool, ChessterPoolBusy
+from chesster.core.uci_frontend import ChessterEngineTimeout
+from chesster.core.metrics import ChessterMetrics, CONTENT_TYPE
+from chesster.core.uci_info import parse_info
+from chesster.core.response_cache import ChessterResponseCache
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from SocketServer import ThreadingMixIn
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson; charset=utf-8'
+EVENT_STREAM_CONTENT_TYPE = 'text/event-stream; charset=utf-8'
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class ChessterThreadingServer(ServerAdapter):
+    """Bottle server adapter serving each request in its own thread"""
+
+    def run(self, handler):
+        handler_class = WSGIRequestHandler
+        if self.quiet:
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(*args, **kw):
+                    pass
+            handler_class = QuietHandler
+        server = make_server(self.host, self.port, handler,
+                             server_class=_ThreadingWSGIServer,
+                             handler_class=handler_class)
+        server.serve_forever()
+
+
+class ChessterServer:
+
+    engine_pool = None
+    """Pool of engines serving the requests"""
+    request_timeout = None
+    """Seconds a request may wait for an engine and search (None waits
+    forever)"""
+    metrics = None
+    """Request and engine metrics exposed on /metrics"""
+    response_cache = None
+    """Cache of /bestmove and /evalpos responses that also lets identical
+    concurrent requests share one search"""
+    max_batch_items = 1000
+    """Maximum number of positions per batch request"""
+    batch_ttm = 1000
+    """Time to move in ms of batch and stream searches without ttm and
+    depth"""
+    stateful_uci_coms = ['position', 'go', 'ponderhit', 'stop']
+    """Uci commands that depend on earlier commands sent to the same engine,
+    rejected on /uci if the pool has more than one engine"""
+
+    def __init__(self, host, port, cache=None, pool_size=1,
+                 max_waiting=None, request_timeout=None, response_ttl=60.0):
+        logging.info('Obtained new server instance.')
+        self.metrics = self._create_metrics()
+        self.request_timeout = request_timeout
+        self.response_cache = ChessterResponseCache(response_ttl)
+        self.engine_pool = ChessterEnginePool(
+            pool_size, cache=cache, max_waiting=max_waiting)
+        for engine in self.engine_pool.engines:
+            engine.metrics = self.metrics
+        route('/')(self._instrument('/', self.bottle_get))
+        route('/uci')(self._instrument('/uci', self.bottle_get_eval_uci))
+        route('/bestmove')(self._instrument('/bestmove',
+                                            self.bottle_get_bestmove))
+        route('/evalpos')(self._instrument('/evalpos',
+                                           self.bottle_get_eval_position))
+        route('/metrics')(self._instrument('/metrics',
+                                           self.bottle_get_metrics))
+        route('/batch', method='POST')(self._instrument(
+            '/batch', self.bottle_post_batch))
+        route('/stream')(self._instrument('/stream',
+                                          self.bottle_get_stream))
+        logging.info('Routed default webservice endpoints.')
+        try:
+            run(host=host, port=port, server=ChessterThreadingServer)
+        finally:
+            self.engine_pool.shutdown()
+
+    def bottle_get(self):
+        if self._accepts_json(request):
+            return self._json_response({'status': 'online'}, response)
+        return self._bottle_generate_response({ 'chesster in online'},
+                                              request, response)
+
+    def bottle_get_eval_uci(self):
+        uci_string = request.query.com
+        if uci_string is None or uci_string == '':
+            abort(400, text='Obligatory parameter \'com\' missing.')
+        # commands are sent to the next idle engine of the pool, so a later
+        # command may not reach the engine an earlier one set up
+        uci_com = uci_string.strip().split(' ')[0]
+        if uci_com in self.stateful_uci_coms and \
+                self.engine_pool.size() > 1:
+            abort(400, text='Command \'{}\' is not supported with more '
+                  'than one engine, use /bestmove, /evalpos or /stream.'
+                  .format(uci_com))
+        output = self._run_on_engine(
+            lambda engine, timeout: engine.eval_uci(uci_string, timeout))
+        if self._accepts_json(request):
+            return self._json_response({'command': uci_string,
+                                        'output': list(output)}, response)
+        return self._bottle_generate_response(output, request, response)
+
+    def bottle_get_bestmove(self):
+        fen_string = request.query.fen
+        ttm = request.query.ttm
+        if not fen_string:
+            abort(400, text='Obligatory parameter \'fen\' missing.')
+        best_move = self._run_cached(
+            '/bestmove', [fen_string, ttm],
+            lambda engine, timeout: engine.bestmove(fen_string, ttm, timeout))
+        if self._accepts_json(request):
+            return self._check_etag(self._json_response({
+                'fen': fen_string.strip(),
+                'bestmove': list(best_move)[0] if best_move else None},
+                response))
+        return self._check_etag(self._bottle_generate_response(
+            best_move, request, response))
+
+    def bottle_get_eval_position(self):
+        fen_string = request.query.fen
+        ttm = request.query.ttm
+        if not fen_string:
+            abort(400, text='Obligatory parameter \'fen\' missing.')
+        evaluation = self._run_cached(
+            '/evalpos', [fen_string, ttm],
+            lambda engine, timeout: engine.eval_position(fen_string, ttm,
+                                                         timeout))
+        if self._accepts_json(request):
+            infos = [parse_info(line) for line in evaluation[2:] if line]
+            return self._check_etag(self._json_response({
+                'fen': evaluation[0],
+                'infos': [info.to_dict() for info in infos if info]},
+                response))
+        return self._check_etag(self._bottle_generate_response(
+            evaluation, request, response))
+
+    def bottle_post_batch(self):
+        """Searches a JSON array of positions, each either a FEN or an
+        object with 'fen' and optional 'ttm', 'depth' and 'multipv', on all
+        engines of the pool and streams one JSON line per position in the
+        order the searches complete."""
+
+        try:
+            items = json.loads(request.body.read().decode('utf-8'))
+        except ValueError:
+            abort(400, text='Request body is not valid JSON.')
+        if not isinstance(items, list):
+            abort(400, text='Request body must be a JSON array.')
+        if len(items) > self.max_batch_items:
+            abort(413, text='Batch exceeds {} positions.'.format(
+                self.max_batch_items))
+        response.content_type = NDJSON_CONTENT_TYPE
+        return self._stream_batch(
+            [self._get_batch_job(idx, item) for idx, item in
+             enumerate(items)])
+
+    def bottle_get_metrics(self):
+        self._update_engine_metrics()
+        response.content_type = CONTENT_TYPE
+        return self.metrics.render()
+
+    def _run_on_engine(self, function):
+        """Calls function(engine, timeout) on the next idle engine with the
+        time left of the request timeout. Answers 503 if the request cannot
+        be queued or no engine becomes available in time."""
+
+        start = default_timer()
+        engine = self._acquire_engine(start)
+        try:
+            return function(engine, self._get_remaining_timeout(start))
+        except ChessterEngineTimeout as e:
+            abort(504, str(e))
+        finally:
+            self.engine_pool.release(engine)
+
+    def _acquire_engine(self, start):
+        try:
+            engine = self.engine_pool.acquire(self.request_timeout)
+        except ChessterPoolBusy as e:
+            self.metrics.inc('chesster_pool_rejected_total')
+            raise HTTPError(503, str(e), **{'Retry-After': '1'})
+        self.metrics.observe('chesster_pool_wait_seconds',
+                             default_timer() - start)
+        return engine
+
+    def _get_remaining_timeout(self, start):
+        if self.request_timeout is None:
+            return None
+        return max(0.001, self.request_timeout - (default_timer() - start))
+
+    def bottle_get_stream(self):
+        """Streams the search progress of a position as server-sent events:
+        an 'info' event per scored info line and a final 'bestmove' event.
+        Clients that close the connection stop the search."""
+
+        fen_string = request.query.fen
+        if not fen_string:
+            abort(400, text='Obligatory parameter \'fen\' missing.')
+        try:
+            job = {'depth': self._get_positive_int(request.query, 'depth',
+                                                   None),
+                   'ttm': self._get_positive_int(request.query, 'ttm',
+                                                 self.batch_ttm),
+                   'multipv': self._get_positive_int(request.query,
+                                                     'multipv', 1)}
+        except ValueError as e:
+            abort(400, text=str(e))
+        start = default_timer()
+        engine = self._acquire_engine(start)
+        response.content_type = EVENT_STREAM_CONTENT_TYPE
+        response.set_header('Cache-Control', 'no-cache')
+        return self._stream_search(engine, start, fen_string.strip(), job)
+
+    def _stream_search(self, engine, start, fen_string, job):
+        events = None
+        try:
+            engine.set_options({'MultiPV': job['multipv']})
+            events = engine.search_iter(
+                fen_string, movetime=job['ttm'], depth=job['depth'],
+                timeout=self._get_remaining_timeout(start))
+            for event, data in events:
+                if event == 'info':
+                    data = data.to_dict()
+                else:
+                    data = {'fen': fen_string, 'bestmove': data}
+                yield 'event: {}\ndata: {}\n\n'.format(
+                    event, json.dumps(data, sort_keys=True))
+        except (ChessterEngineTimeout, IOError) as e:
+            yield 'event: error\ndata: {}\n\n'.format(
+                json.dumps({'error': str(e)}))
+        finally:
+            if events is not None:
+                events.close()
+            self.engine_pool.release(engine)
+
+    def _run_cached(self, route_path, key_parts, function):
+        """Runs function like _run_on_engine unless the response cache holds
+        the result. Identical concurrent requests share one search. Sets the
+        Cache-Control header according to the time the result expires."""
+
+        def search(engine, timeout):
+            # results of stopped searches are not cached as full searches
+            return function(engine, timeout), not engine.search_stopped
+
+        key = '|'.join([route_path] + [str(part).strip()
+                                       for part in key_parts])
+        output, expires = self.response_cache.get(
+            key, lambda: self._run_on_engine(search))
+        response.set_header('Vary', 'Accept')
+        if expires is None:
+            response.set_header('Cache-Control', 'no-cache')
+        else:
+            response.set_header('Cache-Control', 'public, max-age={}'.format(
+                max(0, int(expires - time()))))
+        return output
+
+    def _check_etag(self, content):
+        """Sets the ETag of the response content and answers 304 Not
+        Modified if the client already has it."""
+
+        etag = '"{}"'.format(sha1(content.encode('utf-8')).hexdigest())
+        response.set_header('ETag', etag)
+        if_none_match = request.headers.get('If-None-Match', '')
+        client_etags = [tag.strip().replace('W/', '', 1)
+                        for tag in if_none_match.split(',')]
+        if etag in client_etags or '*' in client_etags:
+            raise HTTPResponse(status=304, headers=dict(
+                (name, response.get_header(name))
+                for name in ['ETag', 'Cache-Control', 'Vary']
+                if response.get_header(name)))
+        return content
+
+    def _get_batch_job(self, idx, item):
+        if not isinstance(item, dict):
+            item = {'fen': item}
+        job = {'index': idx, 'fen': item.get('fen')}
+        try:
+            if not job['fen'] or not hasattr(job['fen'], 'strip'):
+                raise ValueError('Obligatory field \'fen\' missing.')
+            job['fen'] = job['fen'].strip()
+            job['depth'] = self._get_positive_int(item, 'depth', None)
+            job['ttm'] = self._get_positive_int(item, 'ttm', self.batch_ttm)
+            job['multipv'] = self._get_positive_int(item, 'multipv', 1)
+        except ValueError as e:
+            job['error'] = str(e)
+        return job
+
+    def _get_positive_int(self, item, key, default):
+        value = item.get(key)
+        if value is None or value == '':
+            return default
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if value < 1:
+            raise ValueError('Field \'{}\' must be a positive integer.'
+                             .format(key))
+        return value
+
+    def _stream_batch(self, jobs):
+        pending = Queue()
+        for job in jobs:
+            pending.put(job)
+        results = Queue()
+        cancelled = Event()
+        for _ in range(min(len(jobs), self.engine_pool.size())):
+            worker = Thread(target=self._work_batch,
+                            args=(pending, results, cancelled))
+            worker.daemon = True
+            worker.start()
+        try:
+            for _ in jobs:
+                yield json.dumps(results.get(), sort_keys=True) + '\n'
+        finally:
+            # the client disconnected or all results were sent, the workers
+            # must not take engines for remaining jobs
+            cancelled.set()
+
+    def _work_batch(self, pending, results, cancelled):
+        while not cancelled.is_set():
+            try:
+                job = pending.get_nowait()
+            except Empty:
+                return
+            results.put(self._search_batch_job(job))
+
+    def _search_batch_job(self, job):
+        result = {'index': job['index'], 'fen': job['fen']}
+        if 'error' in job:
+            result['error'] = job['error']
+            return result
+        start = default_timer()
+        try:
+            engine = self.engine_pool.acquire(self.request_timeout)
+        except ChessterPoolBusy as e:
+            self.metrics.inc('chesster_pool_rejected_total')
+            result['error'] = str(e)
+            return result
+        self.metrics.observe('chesster_pool_wait_seconds',
+                             default_timer() - start)
+        try:
+            engine.set_options({'MultiPV': job['multipv']})
+            infos, best_move = engine.search(
+                job['fen'], movetime=job['ttm'], depth=job['depth'],
+                timeout=self._get_remaining_timeout(start))
+            result['bestmove'] = best_move
+            result['infos'] = [info.to_dict() for info in infos]
+        except (ChessterEngineTimeout, IOError) as e:
+            result['error'] = str(e)
+        finally:
+            self.engine_pool.release(engine)
+        return result
+
+    def _create_metrics(self):
+        metrics = ChessterMetrics()
+        metrics.describe('chesster_http_requests_total', 'counter',
+                         'HTTP requests by route and status code.')
+        metrics.describe('chesster_http_request_duration_seconds',
+                         'histogram', 'HTTP request latency by route.')
+        metrics.describe('chesster_http_requests_in_flight', 'gauge',
+                         'HTTP requests currently being served.')
+        metrics.describe('chesster_pool_wait_seconds', 'histogram',
+                         'Time requests wait for an idle engine.')
+        metrics.describe('chesster_pool_rejected_total', 'counter',
+                         'Requests rejected with 503 as all engines were '
+                         'busy.')
+        metrics.describe('chesster_pool_idle_engines', 'gauge',
+                         'Engines not serving a request.')
+        metrics.describe('chesster_pool_waiting_requests', 'gauge',
+                         'Requests waiting for an idle engine.')
+        metrics.describe('chesster_engine_lock_wait_seconds', 'histogram',
+                         'Time requests wait for the engine lock.')
+        metrics.describe('chesster_engine_search_seconds', 'histogram',
+                         'Engine search time per search.')
+        metrics.describe('chesster_engine_timeouts_total', 'counter',
+                         'Engine commands that timed out.')
+        metrics.describe('chesster_engine_up', 'gauge',
+                         '1 if the engine process is running.')
+        metrics.describe('chesster_engine_stale_responses', 'gauge',
+                         'Responses of timed out commands not yet received.')
+        metrics.describe('chesster_response_cache_hits_total', 'counter',
+                         'Requests answered by the response cache.')
+        metrics.describe('chesster_response_cache_coalesced_total',
+                         'counter', 'Requests that shared the search of an '
+                         'identical concurrent request.')
+        metrics.describe('chesster_response_cache_misses_total', 'counter',
+                         'Requests that required an engine search.')
+        metrics.set('chesster_http_requests_in_flight', 0)
+        metrics.inc('chesster_engine_timeouts_total', 0)
+        metrics.inc('chesster_pool_rejected_total', 0)
+        return metrics
+
+    def _update_engine_metrics(self):
+        self.metrics.set('chesster_pool_idle_engines',
+                         self.engine_pool.idle())
+        self.metrics.set('chesster_pool_waiting_requests',
+                         self.engine_pool.waiting())
+        for idx, engine in enumerate(self.engine_pool.engines):
+            labels = {'engine': idx}
+            engine_up = engine.engine_proc.poll() is None
+            self.metrics.set('chesster_engine_up', 1 if engine_up else 0,
+                             labels)
+            self.metrics.set('chesster_engine_stale_responses',
+                             engine.stale_responses, labels)
+        response_stats = self.response_cache.get_stats()
+        for name in ['hits', 'coalesced', 'misses']:
+            self.metrics.set('chesster_response_cache_{}_total'.format(name),
+                             response_stats[name])
+        cache = self.engine_pool.engines[0].cache
+        if not cache:
+            return
+        cache_stats = cache.get_stats()
+        self.metrics.describe('chesster_cache_hits_total', 'counter',
+                              'Evaluation cache hits (memory and disk).')
+        self.metrics.describe('chesster_cache_misses_total', 'counter',
+                              'Evaluation cache misses.')
+        self.metrics.describe('chesster_cache_hit_ratio', 'gauge',
+                              'Ratio of searches answered by the cache.')
+        self.metrics.set('chesster_cache_hits_total', cache_stats['hits'])
+        self.metrics.set('chesster_cache_misses_total',
+                         cache_stats['misses'])
+        self.metrics.set('chesster_cache_hit_ratio',
+                         cache_stats['hit_ratio'])
+
+    def _instrument(self, route_path, handler):
+        def instrumented_handler():
+            self.metrics.inc('chesster_http_requests_in_flight')
+            start = default_timer()
+            status = 500
+            streamed = False
+            try:
+                result = handler()
+                status = response.status_code
+                if isinstance(result, GeneratorType):
+                    streamed = True
+                    return self._instrument_stream(route_path, start,
+                                                   status, result)
+                return result
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                if not streamed:
+                    self._record_request(route_path, start, status)
+        return instrumented_handler
+
+    def _instrument_stream(self, route_path, start, status, stream):
+        # streamed responses are sent after the handler returned, so they
+        # are recorded once the stream is exhausted or closed by the client
+        try:
+            for chunk in stream:
+                yield chunk
+        finally:
+            stream.close()
+            self._record_request(route_path, start, status)
+
+    def _record_request(self, route_path, start, status):
+        self.metrics.dec('chesster_http_requests_in_flight')
+        self.metrics.observe('chesster_http_request_duration_seconds',
+                             default_timer() - start, {'route': route_path})
+        self.metrics.inc('chesster_http_requests_total', 1,
+                         {'route': route_path, 'code': status})
+
+    def _accepts_json(self, request):
+        """Returns True if the client prefers JSON over HTML according to
+        the quality values of its Accept header, ties prefer JSON."""
+
+        qualities = {}
+        for media_range in request.headers.get('Accept', '').split(','):
+            params = media_range.strip().split(';')
+            quality = 1.0
+            for param in params[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[params[0].strip().lower()] = quality
+        json_quality = qualities.get('application/json', 0.0)
+        html_quality = qualities.get('text/html', qualities.get(
+            'text/*', qualities.get('*/*', 0.0)))
+        return json_quality > 0.0 and json_quality >= html_quality
+
+    def _json_response(self, content, response):
+        response.content_type = JSON_CONTENT_TYPE
+        return json.dumps(content, sort_keys=True)
+
+    def _bottle_generate_response(self, output, request, response):
+        response.add_header('Content-Type', 'text/html; charset=utf-8')
+        content = ('<html><style>* {{font-family:Consolas;}}</style><body>'
+        + '{0}</body></html>'.format('<br/>'.join(output)))
+        content = sub('\n', '<br/>', content)
+        return content
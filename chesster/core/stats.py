@@ -0,0 +1,135 @@
+import json
+import logging
+from contextlib import contextmanager
+from os import path, makedirs
+from threading import Lock
+from timeit import default_timer
+from tabulate import tabulate
+
+PROFILERS = ['cprofile', 'pyinstrument']
+"""Supported profilers for per-game profiles"""
+
+
+class ChessterStats:
+    """Thread-safe collection of per-stage timers and counters of an
+    analysis run with optional per-game profiling"""
+
+    stages = None
+    """Maps stage names to [calls, total seconds]"""
+    counters = None
+    """Maps counter names to their values"""
+    profile_dir = None
+    """Folder for per-game profiles or None to disable profiling"""
+    profiler = 'cprofile'
+    """Profiler used for per-game profiles"""
+
+    def __init__(self, profile_dir=None, profiler='cprofile'):
+        if profiler not in PROFILERS:
+            raise ValueError('Unknown profiler \'{}\'.'.format(profiler))
+        self.stages = {}
+        self.counters = {}
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self._lock = Lock()
+        self._profile_lock = Lock()
+
+    @contextmanager
+    def timer(self, stage, counter=None):
+        """Times the enclosed block as stage. Stages may be nested, e.g. the
+        search stage is part of the annotate stage. If a counter is given,
+        the elapsed milliseconds are added to it as well."""
+
+        start = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - start
+            with self._lock:
+                entry = self.stages.setdefault(stage, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                if counter:
+                    self.counters[counter] = self.counters.get(
+                        counter, 0.0) + elapsed * 1000.0
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def profile(self, name):
+        """Profiles the enclosed block if a profile folder is set and writes
+        the profile to '<name>.prof' (cProfile) or '<name>.html'
+        (pyinstrument). Blocks running in parallel are not profiled, as
+        profilers cannot run in several threads at once."""
+
+        if not self.profile_dir or not self._profile_lock.acquire(False):
+            yield
+            return
+        try:
+            profiler = self._start_profiler()
+            try:
+                yield
+            finally:
+                if profiler:
+                    self._write_profile(profiler, name)
+        finally:
+            self._profile_lock.release()
+
+    def get_report(self):
+        """Returns stages and counters as a dictionary."""
+
+        with self._lock:
+            stages = {}
+            for stage, (calls, total) in self.stages.items():
+                stages[stage] = {
+                    'calls': calls,
+                    'total_ms': total * 1000.0,
+                    'mean_ms': total * 1000.0 / calls if calls else 0.0,
+                }
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def get_table(self):
+        report = self.get_report()
+        rows = [[stage, values['calls'], values['total_ms'],
+                 values['mean_ms']]
+                for stage, values in sorted(report['stages'].items(),
+                                            key=lambda item:
+                                            -item[1]['total_ms'])]
+        table = tabulate(rows, ['stage', 'calls', 'total_ms', 'mean_ms'],
+                         tablefmt='psql', floatfmt='.1f')
+        rows = sorted(report['counters'].items())
+        return table + '\n' + tabulate(rows, ['counter', 'value'],
+                                       tablefmt='psql', floatfmt='.1f')
+
+    def write_report(self, report_file):
+        with open(report_file, 'w') as ofile:
+            json.dump(self.get_report(), ofile, indent=2, sort_keys=True)
+
+    def _start_profiler(self):
+        try:
+            if self.profiler == 'pyinstrument':
+                from pyinstrument import Profiler
+                profiler = Profiler()
+                profiler.start()
+            else:
+                from cProfile import Profile
+                profiler = Profile()
+                profiler.enable()
+        except (ImportError, ValueError) as e:
+            logging.warning('Cannot start profiler {}: {}'
+                            .format(self.profiler, e))
+            return None
+        return profiler
+
+    def _write_profile(self, profiler, name):
+        if not path.isdir(self.profile_dir):
+            makedirs(self.profile_dir)
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            with open(path.join(self.profile_dir, name + '.html'),
+                      'w') as ofile:
+                ofile.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(path.join(self.profile_dir, name + '.prof'))
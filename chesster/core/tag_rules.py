@@ -0,0 +1,134 @@
+import logging
+import re
+from os import path
+from threading import Lock
+from dateutil.parser import parse
+
+_REPLACE_COUNT = 2
+"""Matches replaced per rule. Patterns used to be applied with
+re.sub(search, replace, tag, re.IGNORECASE) which passes the flag as count,
+so rules are case sensitive and replace at most two matches."""
+_SPECIAL_CHARS = '.^$*+?{}[]|()'
+_KEY_PATTERN = re.compile('^\\\\\\[([A-Za-z0-9_]+) ')
+
+_rule_sets = {}
+_rule_sets_lock = Lock()
+_dates = {}
+
+
+class ChessterTagRules:
+    """Search and replace rules of a tag replace pattern file, compiled
+    once and applied in the order of the file"""
+
+    pattern_file = None
+    """Path of the pattern file"""
+    mtime = None
+    """Modification time of the pattern file when it was loaded"""
+    rules = None
+    """List of (required text, literal search, compiled search, replace)
+    tuples, the literal search is set if the search has no regex syntax"""
+    combined = None
+    """Alternation of all searches to skip tags no rule matches, None if
+    the searches cannot be combined"""
+
+    def __init__(self, pattern_file, mtime=None):
+        self.pattern_file = pattern_file
+        self.mtime = mtime
+        self.rules = []
+        searches = []
+        with open(pattern_file) as pattern_fh:
+            for pattern_line in pattern_fh:
+                search_replace = pattern_line.strip().split('=')
+                if len(search_replace) != 2:
+                    continue
+                search, replace = search_replace
+                compiled = re.compile(search)
+                literal = _get_literal(search)
+                if literal is not None and '\\' in replace:
+                    literal = None
+                self.rules.append((_get_required_text(search), literal,
+                                   compiled, replace))
+                searches.append(compiled)
+        self.combined = _get_combined(searches)
+
+    def apply(self, tag):
+        if self.combined and not self.combined.search(tag):
+            return tag
+        for required, literal, compiled, replace in self.rules:
+            if required and required not in tag:
+                continue
+            if literal is not None:
+                tag = tag.replace(literal, replace, _REPLACE_COUNT)
+            else:
+                tag = compiled.sub(replace, tag, _REPLACE_COUNT)
+        return tag
+
+
+def get_tag_rules(pattern_file):
+    """Returns the compiled rules of the pattern file. Rules are shared by
+    all analyses and only compiled again if the file was modified."""
+
+    mtime = path.getmtime(pattern_file)
+    with _rule_sets_lock:
+        tag_rules = _rule_sets.get(pattern_file)
+        if tag_rules and tag_rules.mtime == mtime:
+            return tag_rules
+        tag_rules = ChessterTagRules(pattern_file, mtime)
+        _rule_sets[pattern_file] = tag_rules
+    logging.info('-- compiled {} tag replace rules from {}'
+                 .format(len(tag_rules.rules), pattern_file))
+    return tag_rules
+
+
+def parse_date(value):
+    """Returns (year, month, day) of a date tag value, parsed once per
+    distinct value."""
+
+    try:
+        return _dates[value]
+    except KeyError:
+        date_obj = parse(value)
+        date = (date_obj.year, date_obj.month, date_obj.day)
+        _dates[value] = date
+        return date
+
+
+def _get_literal(search):
+    # returns the text matched by a search without regex syntax
+    literal = []
+    escaped = False
+    for char in search:
+        if escaped:
+            if char.isalnum():
+                return None
+            literal.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in _SPECIAL_CHARS:
+            return None
+        else:
+            literal.append(char)
+    if escaped or not literal:
+        return None
+    return ''.join(literal)
+
+
+def _get_required_text(search):
+    # searches for a tag start with the escaped tag key, e.g. '\[Round '
+    match_ob = _KEY_PATTERN.match(search)
+    if not match_ob or '|' in search:
+        return None
+    return '[{} '.format(match_ob.group(1))
+
+
+def _get_combined(searches):
+    # group references and inline flags change meaning in an alternation
+    if not searches or any(compiled.groups or '(?' in compiled.pattern
+                           for compiled in searches):
+        return None
+    try:
+        return re.compile('|'.join('(?:{})'.format(compiled.pattern)
+                                   for compiled in searches))
+    except re.error:
+        return None
@@ -1,11 +1,31 @@
 import logging
+import re
 from os import path
-from threading import Thread, Lock
-from time import sleep
+from threading import Thread, Lock, RLock
+from timeit import default_timer
 from bptbx.b_cmdline import get_command_process, get_platform
 from bptbx.b_legacy import get_python_major_version
+from chesster.core.board import DEFAULT_FEN
 from chesster.core.position import Position
+from chesster.core.uci_info import parse_info
 from chesster.core import externals
+try:
+    from queue import Queue, Empty
+except ImportError:  # python 2
+    from Queue import Queue, Empty
+
+OPTION_PROFILES = {
+    'evalpos': {'MultiPV': '3'},
+    'bestmove': {'MultiPV': '1'},
+}
+"""Named engine option sets applied by the request types of the frontend.
+Engine-wide options like Hash, Threads and Skill Level are left to
+init_engine, as changing Hash makes the engine reallocate and clear its
+hash table."""
+
+
+class ChessterEngineTimeout(Exception):
+    """Raised if the engine does not answer a command in time"""
 
 
 class ChessterUciFrontend:
@@ -21,110 +41,485 @@ class ChessterUciFrontend:
     """Path to pgn extract binary"""
     pgn_extract_eco = None
     """Path to pgn extract opening book"""
-    output = []
-    """A shared container for the engine's output"""
+    output = None
+    """A container for the engine's output of the running command apart
+    from info lines"""
+    infos = None
+    """Maps multipv to the latest scored info record of the running
+    command"""
+    responses = None
+    """Queue handing over completed engine responses to the caller"""
+    response_terminators = ['uciok', 'readyok', 'bestmove']
+    """Engine output that completes the response to a command"""
     no_response_coms = ['position', 'setoption', 'ucinewgame', 'quit']
     """Uci commands that don't require evaluating the response"""
-    lock = Lock()
+    lock = None
     """Re-entrance lock for core engine operations"""
-    signal = False
-    """Signal that engine is finished operating"""
+    engine_id = None
+    """Engine name as reported by the engine on 'uci'"""
+    engine_options = None
+    """Maps lower case option names to the values set through this
+    frontend, as UCI option names are case-insensitive"""
+    option_profiles = None
+    """Maps profile names to option sets applied by use_profile"""
+    cache = None
+    """Optional evaluation cache consulted before searching a position"""
+    timeout = None
+    """Seconds to wait for an engine response (None waits forever)"""
+    stop_grace = 2.0
+    """Seconds to wait for the bestmove after stopping a timed out search"""
+    stale_responses = 0
+    """Number of responses of timed out commands still to be discarded"""
+    metrics = None
+    """Optional metrics registry for lock wait and engine search times"""
+    search_stopped = False
+    """True if the last search was stopped before reaching its limit"""
+    searching = False
+    """True while a search is running"""
+    info_callback = None
+    """Called with each scored info record of the running search, the search
+    is stopped if it returns True"""
+    ponder_move = None
+    """Reply the engine expects to its last best move, if it reported one"""
+    pondering = None
+    """Position and move the engine is pondering on or None"""
 
-    def __init__(self):
+    def __init__(self, timeout=None, cache=None):
         platform_type = get_platform()
         self.engine_path = externals.get_stockfish_path()
         self.pgn_extract_path = externals.get_pgn_extract_path()
         self.pgn_extract_eco = externals.get_pgn_extract_opening_book()
+        # engine state is kept per instance so that several frontends, e.g.
+        # inside an engine pool, can drive their own engine processes
+        self.output = []
+        self.infos = {}
+        self.responses = Queue()
+        self.lock = RLock()
+        self._write_lock = Lock()
+        self.timeout = timeout
+        self.engine_id = self.engine_path
+        self.engine_options = {}
+        self.option_profiles = dict(OPTION_PROFILES)
+        self.cache = cache
+        self.stale_responses = 0
         self.engine_proc = get_command_process(self.engine_path)
         self.engine_thread = Thread(target=self._handle_engine_output)
         self.engine_thread.start()
 
     def init_engine(self, options={}):
-        self.eval_uci('uci')
+        for line in self.eval_uci('uci'):
+            if line.startswith('id name '):
+                self.engine_id = line[len('id name '):].strip()
         for option in options:
             self.eval_uci(option)
         self.eval_uci('isready')
 
-    def eval_uci(self, uci_string):
+    def eval_uci(self, uci_string, timeout=None):
         if uci_string is None:
             return 'Nothing to do.'
         uci_string = uci_string.strip()
         uci_com = uci_string.split(' ')[0]
-        if any(uci_com in s for s in self.no_response_coms):
+        if uci_com in self.no_response_coms:
             self._eval_uci_async(uci_string)
             return {'Ok.'}
-        else:
-            return self._eval_uci_sync(uci_string)
+        self._acquire_lock()
+        try:
+            lines, infos = self._eval_uci_sync(uci_string, timeout)
+        finally:
+            self.lock.release()
+        return [str(info) for info in infos] + lines
 
-    def eval_position(self, fen_string, ttm):
+    def eval_position(self, fen_string, ttm, timeout=None):
         output = []
         fen_string = fen_string.strip()
         output.append(fen_string)
         position = Position(fen_string)
         output.append(position.fen_to_string_board())
-        self._eval_uci_async('setoption name Hash value 32')
-        self._eval_uci_async('setoption name Threads value 2')
-        self._eval_uci_async('setoption name Skill Level value 20')
-        self._eval_uci_async('setoption name MultiPV value 3')
-        self._eval_uci_async('position fen {0}'.format(fen_string))
-        uciout = self._eval_uci_sync('go movetime {0}'.format(ttm))
-        output.append(self._get_last_entry_for_pattern(uciout, 'multipv 1'))
-        output.append(self._get_last_entry_for_pattern(uciout, 'multipv 2'))
-        output.append(self._get_last_entry_for_pattern(uciout, 'multipv 3'))
+        self._acquire_lock()
+        try:
+            self.use_profile('evalpos')
+            infos, _ = self.search(fen_string, movetime=ttm, timeout=timeout)
+        finally:
+            self.lock.release()
+        for multipv in range(3):
+            output.append(str(infos[multipv]) if multipv < len(infos)
+                          else None)
         return output
 
-    def bestmove(self, fen_string, ttm):
+    def bestmove(self, fen_string, ttm, timeout=None):
+        self._acquire_lock()
+        try:
+            self.use_profile('bestmove')
+            _, best_move = self.search(fen_string, movetime=ttm,
+                                       timeout=timeout)
+        finally:
+            self.lock.release()
+        if best_move:
+            return {best_move}
+
+    def set_options(self, options):
+        """Sets the given engine options (a dict of option names to values)
+        and returns the names of the options sent. Options already set to
+        the same value are not sent again. Options with value None, i.e.
+        buttons like 'Clear Hash', are always sent."""
+
+        changed = []
+        with self.lock:
+            for name, value in sorted(options.items()):
+                if value is None:
+                    self._eval_uci_async('setoption name {}'.format(name))
+                    self.engine_options.pop(name.lower(), None)
+                    changed.append(name)
+                    continue
+                value = str(value)
+                if self.engine_options.get(name.lower()) == value:
+                    continue
+                self._eval_uci_async('setoption name {} value {}'
+                                     .format(name, value))
+                changed.append(name)
+        if changed:
+            logging.debug('[ENGINE] changed options: {}'.format(changed))
+        return changed
+
+    def use_profile(self, profile):
+        """Applies the named option profile, see option_profiles."""
+
+        try:
+            options = self.option_profiles[profile]
+        except KeyError:
+            raise ValueError('Unknown option profile \'{}\'.'
+                             .format(profile))
+        return self.set_options(options)
+
+    def search(self, fen_string, movetime=None, depth=None, start_fen=None,
+               moves=None, timeout=None, on_info=None):
+        """Searches the position and returns the latest scored info record
+        per multipv (ordered by multipv) and the engine's best move. Results
+        are taken from the evaluation cache if available. If moves are given,
+        the position is sent as start position plus the moves leading to the
+        searched position given by fen_string. A search exceeding the
+        timeout is stopped and returns the best move found so far. on_info
+        is called with each scored info record while the search runs (or
+        with the cached records) and stops the search if it returns True."""
+
         fen_string = fen_string.strip()
-        self._eval_uci_async('position fen {0}'.format(fen_string))
-        output = self._eval_uci_sync('go movetime {0}'.format(ttm))
-        for line in output:
-            if 'bestmove' in line:
-                return {line.split(' ')[1]}
+        if depth:
+            limit = 'depth {}'.format(depth)
+        else:
+            limit = 'movetime {}'.format(movetime)
+        self._acquire_lock()
+        try:
+            self.search_stopped = False
+            cache_key = None
+            if self.cache:
+                cache_key = self.cache.get_key(
+                    fen_string, self.engine_id, self.engine_options, limit)
+                cached = self.cache.get(cache_key)
+                if cached:
+                    infos = [parse_info(line) for line in cached['infos']]
+                    for info in infos if on_info else []:
+                        on_info(info)
+                    self.ponder_move = cached.get('ponder')
+                    return infos, cached['bestmove']
+            self._eval_uci_async(
+                self._get_position_command(fen_string, start_fen, moves))
+            start = default_timer()
+            self.info_callback = on_info
+            self.searching = True
+            try:
+                lines, infos = self._eval_uci_sync('go {}'.format(limit),
+                                                   timeout)
+            finally:
+                self.searching = False
+                self.info_callback = None
+            self._observe('chesster_engine_search_seconds',
+                          default_timer() - start)
+            best_move = self._get_best_move(lines)
+            self.ponder_move = self._get_ponder_move(lines)
+            # results of stopped searches are not cached as full searches
+            if self.cache and best_move and not self.search_stopped:
+                self.cache.put(cache_key,
+                               {'infos': [str(info) for info in infos],
+                                'bestmove': best_move,
+                                'ponder': self.ponder_move})
+            return infos, best_move
+        finally:
+            self.lock.release()
+
+    def ponder(self, fen_string, movetime, ponder_move=None):
+        """Lets the engine search the position after ponder_move (default:
+        the engine's expected reply) on fen_string while the opponent
+        thinks. Call ponderhit if the opponent played ponder_move. Any other
+        command stops pondering first. Returns False if there is no move to
+        ponder on."""
+
+        ponder_move = ponder_move or self.ponder_move
+        if not ponder_move:
+            return False
+        fen_string = fen_string.strip()
+        self._acquire_lock()
+        try:
+            self.stop_ponder()
+            self.set_options({'Ponder': 'true'})
+            self._eval_uci_async(self._get_position_command(
+                fen_string, fen_string, [ponder_move]))
+            self.search_stopped = False
+            self.searching = True
+            self._write_command('go ponder movetime {}'.format(movetime))
+            self.pondering = (fen_string, ponder_move)
+            return True
+        finally:
+            self.lock.release()
+
+    def ponderhit(self, timeout=None):
+        """Tells the pondering engine that the opponent played the expected
+        move. The search continues as normal search, with the time spent
+        pondering counting towards its movetime. Returns the latest scored
+        info record per multipv and the best move like search."""
+
+        self._acquire_lock()
+        try:
+            if not self.pondering:
+                raise ValueError('Engine is not pondering.')
+            self.pondering = None
+            try:
+                lines, infos = self._eval_uci_sync('ponderhit', timeout)
+            finally:
+                self.searching = False
+            self.ponder_move = self._get_ponder_move(lines)
+            return infos, self._get_best_move(lines)
+        finally:
+            self.lock.release()
+
+    def stop_ponder(self):
+        """Stops pondering, e.g. if the opponent did not play the expected
+        move, and discards its result. Returns False if the engine was not
+        pondering."""
+
+        if not self.pondering:
+            return False
+        self.lock.acquire()
+        try:
+            if not self.pondering:
+                return False
+            self.pondering = None
+            try:
+                self._eval_uci_sync('stop')
+            finally:
+                self.searching = False
+            return True
+        finally:
+            self.lock.release()
+
+    def search_iter(self, fen_string, movetime=None, depth=None,
+                    timeout=None):
+        """Searches like search, but yields ('info', record) for each scored
+        info record while the search runs and finally ('bestmove', move).
+        Closing the generator early stops the search."""
+
+        events = Queue()
+        closed = []
+
+        def on_info(info):
+            events.put(('info', info))
+            return bool(closed)
+
+        def run_search():
+            try:
+                _, best_move = self.search(fen_string, movetime, depth,
+                                           timeout=timeout, on_info=on_info)
+                events.put(('bestmove', best_move))
+            except Exception as e:
+                events.put(('error', e))
+
+        search_thread = Thread(target=run_search)
+        search_thread.daemon = True
+        search_thread.start()
+        try:
+            while True:
+                event, data = events.get()
+                if event == 'error':
+                    raise data
+                yield event, data
+                if event == 'bestmove':
+                    return
+        finally:
+            if search_thread.is_alive():
+                closed.append(True)
+                self.stop_search()
+                search_thread.join()
+
+    def stop_search(self):
+        """Stops the running search, which then returns the best move found
+        so far. May be called from any thread. Returns False if no search
+        was running or it is already being stopped."""
+
+        if not self.searching or self.search_stopped:
+            return False
+        self.search_stopped = True
+        self._write_command('stop')
+        return True
 
     def shutdown(self):
+        try:
+            self.engine_proc.stdin.write(self._pack_engine_in('quit'))
+            self.engine_proc.stdin.flush()
+        except IOError:
+            pass  # engine is already gone
         self.engine_proc.kill()
-        self.engine_proc.stdin.write(self._pack_engine_in('uci'))
-        self.engine_proc.stdin.flush()
 
-    def _eval_uci_sync(self, command):
+    def _eval_uci_sync(self, command, timeout=None):
+        """Sends a command and returns the engine's response as list of
+        output lines and list of info records ordered by multipv."""
+
+        if timeout is None:
+            timeout = self.timeout
         self.lock.acquire()
         try:
-            logging.debug('[ENGINE] [IN] {0}'.format(command))
-            self.engine_proc.stdin.write(self._pack_engine_in(command))
-            self.engine_proc.stdin.flush()
-            while self.signal == False:
-                sleep(0.1)
-            uci_engine_output = self.output
-            self.output = []
-            self.signal = False
+            self.stop_ponder()
+            self._discard_stale_responses(timeout)
+            # raw searches, e.g. sent through eval_uci, are stopped on
+            # timeouts like the searches started by search
+            raw_search = command.split(' ')[0] == 'go' and not self.searching
+            if raw_search:
+                self.search_stopped = False
+                self.searching = True
+            try:
+                self._write_command(command)
+                try:
+                    uci_engine_output = self.responses.get(timeout=timeout)
+                except Empty:
+                    uci_engine_output = self._handle_timeout(command)
+            finally:
+                if raw_search:
+                    self.searching = False
+            if uci_engine_output is None:
+                raise IOError('Engine process terminated.')
             return uci_engine_output
         finally:
             self.lock.release()
 
+    def _acquire_lock(self):
+        start = default_timer()
+        self.lock.acquire()
+        self._observe('chesster_engine_lock_wait_seconds',
+                      default_timer() - start)
+
+    def _observe(self, name, value):
+        if self.metrics:
+            self.metrics.observe(name, value)
+
+    def _handle_timeout(self, command):
+        if self.metrics:
+            self.metrics.inc('chesster_engine_timeouts_total')
+        if not command.startswith('go') and command != 'ponderhit':
+            self.stale_responses += 1
+            raise ChessterEngineTimeout(
+                'No engine response for \'{}\'.'.format(command))
+        # stop the search to get the best move found so far
+        logging.warning('[ENGINE] search timed out, stopping: {}'
+                        .format(command))
+        self.stop_search()
+        try:
+            return self.responses.get(timeout=self.stop_grace)
+        except Empty:
+            self.stale_responses += 1
+            raise ChessterEngineTimeout(
+                'Engine did not stop search for \'{}\'.'.format(command))
+
+    def _discard_stale_responses(self, timeout):
+        # responses of timed out commands arrive before any new response
+        while self.stale_responses > 0:
+            try:
+                self.responses.get(timeout=timeout)
+            except Empty:
+                raise ChessterEngineTimeout('Engine is not responding.')
+            self.stale_responses -= 1
+
     def _eval_uci_async(self, command):
         self.lock.acquire()
         try:
+            self.stop_ponder()
+            if command.startswith('setoption'):
+                self._track_option(command)
+            self._write_command(command)
+        finally:
+            self.lock.release()
+
+    def _write_command(self, command):
+        # the lock keeps 'stop' sent from other threads from interleaving
+        with self._write_lock:
             logging.debug('[ENGINE] [IN] {0}'.format(command))
             self.engine_proc.stdin.write(self._pack_engine_in(command))
             self.engine_proc.stdin.flush()
-        finally:
-            self.lock.release()
 
-    def _get_last_entry_for_pattern(self, entries, pattern):
-        last_entry = None
-        for entry in entries:
-            if pattern in entry:
-                last_entry = entry
-        return last_entry
+    def _get_position_command(self, fen_string, start_fen=None, moves=None):
+        if moves is None:
+            return 'position fen {0}'.format(fen_string)
+        if start_fen is None or start_fen.strip() == DEFAULT_FEN:
+            position = 'position startpos'
+        else:
+            position = 'position fen {0}'.format(start_fen.strip())
+        if moves:
+            position += ' moves ' + ' '.join(moves)
+        return position
+
+    def _track_option(self, command):
+        match_ob = re.match('setoption name (.+?)(?: value (.*))?$', command)
+        if match_ob:
+            self.engine_options[match_ob.group(1).strip().lower()] = \
+                match_ob.group(2)
+
+    def _get_best_move(self, entries):
+        for entry in reversed(entries):
+            if entry.startswith('bestmove'):
+                return entry.split(' ')[1]
+        return None
+
+    def _get_ponder_move(self, entries):
+        for entry in reversed(entries):
+            if entry.startswith('bestmove'):
+                tokens = entry.split(' ')
+                if len(tokens) > 3 and tokens[2] == 'ponder':
+                    return tokens[3]
+                return None
+        return None
 
     def _handle_engine_output(self):
-        while True and self.engine_proc.poll() is None:
-            line = self._pack_engine_out(self.engine_proc.stdout.readline())
+        while self.engine_proc.poll() is None:
+            raw_line = self.engine_proc.stdout.readline()
+            if not raw_line:
+                break
+            line = self._pack_engine_out(raw_line)
+            if not line:
+                continue
+            logging.debug('[ENGINE] [OU] {0}'.format(line))
+            if line.startswith('info'):
+                # only the latest info per line is kept to bound the buffer
+                record = parse_info(line)
+                if record and record.has_score():
+                    self.infos[record.multipv] = record
+                    self._notify_info(record)
+                continue
             self.output.append(line)
-            if line:
-                logging.debug('[ENGINE] [OU] {0}'.format(line))
-            if 'uciok' in line or 'bestmove' in line or 'readyok' in line:
-                self.signal = True
+            if line.split(' ')[0] in self.response_terminators:
+                # wake up the waiting caller right away
+                infos = [self.infos[multipv] for multipv in sorted(self.infos)]
+                self.responses.put((self.output, infos))
+                self.output = []
+                self.infos = {}
+        # unblock a waiting caller if the engine went away
+        self.responses.put(None)
+
+    def _notify_info(self, record):
+        callback = self.info_callback
+        if not callback:
+            return
+        try:
+            if callback(record):
+                self.stop_search()
+        except Exception as e:
+            logging.error('[ENGINE] info callback failed: {}'.format(e))
 
     def _pack_engine_in(self, command):
         pyv = get_python_major_version()
@@ -0,0 +1,131 @@
+INT_FIELDS = ['depth', 'seldepth', 'multipv', 'nodes', 'nps', 'time',
+              'hashfull', 'tbhits', 'sbhits', 'cpuload', 'currmovenumber']
+"""Info keys followed by a single integer value"""
+MOVE_LIST_FIELDS = ['pv', 'refutation', 'currline']
+"""Info keys followed by a list of moves"""
+BOUNDS = ['lowerbound', 'upperbound']
+"""Markers of scores that are only a bound of the real score"""
+
+_KEYS = set(INT_FIELDS + MOVE_LIST_FIELDS + ['score', 'currmove', 'string'])
+
+
+class InfoRecord:
+    """A single 'info' line sent by a UCI engine"""
+
+    line = None
+    """The line as sent by the engine"""
+    depth = None
+    seldepth = None
+    multipv = 1
+    """Number of the principal variation, 1 for the best line"""
+    score_type = None
+    """'cp' or 'mate'"""
+    score_value = None
+    """Centipawns or moves to mate from the engine's point of view"""
+    bound = None
+    """'lowerbound', 'upperbound' or None for exact scores"""
+    nodes = None
+    nps = None
+    time = None
+    hashfull = None
+    tbhits = None
+    sbhits = None
+    cpuload = None
+    currmove = None
+    currmovenumber = None
+    pv = None
+    """Principal variation as a list of LAN moves"""
+    refutation = None
+    currline = None
+    string = None
+    """Free text sent with 'info string'"""
+
+    def __init__(self, line):
+        self.line = line
+        self.pv = []
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return 'InfoRecord({!r})'.format(self.line)
+
+    def has_score(self):
+        return self.score_type is not None
+
+    def get_score_string(self):
+        """Returns the score as in the engine's output, e.g. 'cp 20' or
+        'mate -3 upperbound', or None if the line has no score."""
+
+        if not self.has_score():
+            return None
+        score = '{} {}'.format(self.score_type, self.score_value)
+        if self.bound:
+            score += ' ' + self.bound
+        return score
+
+    def get_pv_string(self):
+        return ' '.join(self.pv) if self.pv else None
+
+    def to_dict(self):
+        """Returns the search information as JSON-serializable dict."""
+
+        score = None
+        if self.has_score():
+            score = {'type': self.score_type, 'value': self.score_value,
+                     'bound': self.bound}
+        return {'depth': self.depth, 'seldepth': self.seldepth,
+                'multipv': self.multipv, 'score': score, 'nodes': self.nodes,
+                'nps': self.nps, 'time': self.time, 'pv': list(self.pv)}
+
+
+def parse_info(line):
+    """Returns an InfoRecord for an engine 'info' line or None for any other
+    line. Unknown keys and malformed values are skipped."""
+
+    tokens = line.split()
+    if not tokens or tokens[0] != 'info':
+        return None
+    record = InfoRecord(line)
+    idx = 1
+    while idx < len(tokens):
+        key = tokens[idx]
+        idx += 1
+        if key == 'string':
+            record.string = ' '.join(tokens[idx:])
+            break
+        elif key in INT_FIELDS:
+            if idx < len(tokens):
+                try:
+                    setattr(record, key, int(tokens[idx]))
+                except ValueError:
+                    pass
+                idx += 1
+        elif key == 'score':
+            idx = _parse_score(record, tokens, idx)
+        elif key == 'currmove':
+            if idx < len(tokens):
+                record.currmove = tokens[idx]
+                idx += 1
+        elif key in MOVE_LIST_FIELDS:
+            moves = []
+            while idx < len(tokens) and tokens[idx] not in _KEYS:
+                moves.append(tokens[idx])
+                idx += 1
+            setattr(record, key, moves)
+    return record
+
+
+def _parse_score(record, tokens, idx):
+    if idx + 1 >= len(tokens) or tokens[idx] not in ('cp', 'mate'):
+        return idx
+    try:
+        record.score_value = int(tokens[idx + 1])
+    except ValueError:
+        return idx + 2
+    record.score_type = tokens[idx]
+    idx += 2
+    if idx < len(tokens) and tokens[idx] in BOUNDS:
+        record.bound = tokens[idx]
+        idx += 1
+    return idx
@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import struct
+from os import path, listdir, read, close, O_NONBLOCK
+from chesster.core.pgn import read_tags
+
+IN_CLOSE_WRITE = 0x00000008
+"""inotify event: file opened for writing was closed"""
+IN_MOVED_TO = 0x00000080
+"""inotify event: file was moved into the watched folder"""
+IN_Q_OVERFLOW = 0x00004000
+"""inotify event: event queue overflowed"""
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def has_tag(pgn_file, tag_key):
+    """Returns true if the first game of a PGN file has the given tag. Only
+    the tag section is read."""
+
+    with open(pgn_file) as ifile:
+        for key, _ in read_tags(ifile):
+            if key == tag_key:
+                return True
+    return False
+
+
+class ChessterFolderWatcher:
+    """Reports new or changed files in a folder. Uses inotify on Linux and
+    falls back to listing the folder on other platforms."""
+
+    folder = None
+    """Watched folder"""
+    suffix = None
+    """Suffix of reported files"""
+
+    def __init__(self, folder, suffix='.pgn'):
+        self.folder = path.abspath(folder)
+        self.suffix = suffix
+        self._inotify_fd = None
+        self._full_scan = True
+        try:
+            self._init_inotify()
+        except (OSError, AttributeError) as e:
+            logging.info('-- inotify not available, polling {}: {}'
+                         .format(self.folder, e))
+
+    def get_changed_files(self):
+        """Returns the paths of files that may have changed since the last
+        call. The first call and calls without inotify list all files."""
+
+        if self._inotify_fd is None or self._full_scan:
+            self._full_scan = False
+            if self._inotify_fd is not None:
+                self._read_events()  # events before the scan are covered
+            return self._list_files()
+        names = self._read_events()
+        if names is None:
+            # events were lost, scan the whole folder once
+            return self._list_files()
+        return [path.join(self.folder, name) for name in sorted(names)
+                if name.endswith(self.suffix) and
+                path.isfile(path.join(self.folder, name))]
+
+    def close(self):
+        if self._inotify_fd is not None:
+            close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _list_files(self):
+        file_paths = []
+        for name in sorted(listdir(self.folder)):
+            file_path = path.join(self.folder, name)
+            if name.endswith(self.suffix) and path.isfile(file_path):
+                file_paths.append(file_path)
+        return file_paths
+
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_fd = libc.inotify_init1(O_NONBLOCK)
+        if inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watch = libc.inotify_add_watch(
+            inotify_fd, self.folder.encode('utf-8'),
+            IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch < 0:
+            close(inotify_fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self._inotify_fd = inotify_fd
+        logging.info('-- watching {} with inotify'.format(self.folder))
+
+    def _read_events(self):
+        names = set()
+        while True:
+            try:
+                buf = read(self._inotify_fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return names
+                raise
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning('-- inotify queue overflow')
+                    self._read_remaining_events()
+                    return None
+                if name:
+                    names.add(name.decode('utf-8'))
+
+    def _read_remaining_events(self):
+        try:
+            while read(self._inotify_fd, 64 * 1024):
+                pass
+        except OSError:
+            pass
+
+
+class ChessterProcessedIndex:
+    """Persisted index of processed files keyed by path, modification time
+    and size. The index file is appended to, one file per line."""
+
+    index_file = None
+    """Path to the index file"""
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._entries = {}
+        self._load()
+
+    def __contains__(self, file_path):
+        if file_path not in self._entries:
+            return False
+        signature = self._entries[file_path]
+        # entries of the old log format only contain the path
+        return signature is None or signature == self.get_signature(
+            file_path)
+
+    def add(self, file_path, signature=None):
+        """Adds a file with its current or the given signature."""
+
+        signature = signature or self.get_signature(file_path)
+        self._entries[file_path] = signature
+        with open(self.index_file, 'a') as ofile:
+            ofile.write('{}\t{}\t{}\n'.format(file_path, *signature))
+
+    def get_signature(self, file_path):
+        """Returns the modification time and size of a file or None, if it
+        does not exist."""
+
+        try:
+            return (repr(path.getmtime(file_path)),
+                    str(path.getsize(file_path)))
+        except OSError:
+            return None
+
+    def _load(self):
+        if not path.exists(self.index_file):
+            return
+        with open(self.index_file) as ifile:
+            for line in ifile:
+                fields = line.rstrip('\n').split('\t')
+                if not fields[0]:
+                    continue
+                self._entries[fields[0]] = tuple(fields[1:3]) \
+                    if len(fields) >= 3 else None
+        logging.info('-- loaded {} processed files from {}'
+                     .format(len(self._entries), self.index_file))
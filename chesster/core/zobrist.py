@@ -0,0 +1,62 @@
+from random import Random
+
+PIECES = 'PNBRQKpnbrqk'
+"""Piece letters as used in FEN"""
+CASTLING = 'KQkq'
+"""Castling rights as used in FEN"""
+
+_random = Random(20140916)
+_PIECE_KEYS = dict((piece, [_random.getrandbits(64) for _ in range(64)])
+                   for piece in PIECES)
+_CASTLING_KEYS = dict((right, _random.getrandbits(64)) for right in CASTLING)
+_EN_PASSANT_KEYS = [_random.getrandbits(64) for _ in range(8)]
+_BLACK_TO_MOVE_KEY = _random.getrandbits(64)
+
+
+def get_zobrist_key(fen_string):
+    """Returns a 64 bit Zobrist hash of the position given as FEN. The move
+    clocks are ignored and, as in Polyglot books, the en passant square only
+    counts if a pawn can capture on it, so transpositions share one key."""
+
+    fields = fen_string.split()
+    board = _get_board(fields[0])
+    key = 0
+    for square, piece in enumerate(board):
+        if piece:
+            key ^= _PIECE_KEYS[piece][square]
+    black_to_move = len(fields) > 1 and fields[1] == 'b'
+    if black_to_move:
+        key ^= _BLACK_TO_MOVE_KEY
+    if len(fields) > 2:
+        for right in fields[2]:
+            key ^= _CASTLING_KEYS.get(right, 0)
+    if len(fields) > 3 and _can_capture_en_passant(board, fields[3],
+                                                   black_to_move):
+        key ^= _EN_PASSANT_KEYS['abcdefgh'.index(fields[3][0])]
+    return key
+
+
+def _get_board(placement):
+    # squares are indexed from a8 (0) to h1 (63) as written in FEN
+    board = []
+    for char in placement:
+        if char.isdigit():
+            board.extend([None] * int(char))
+        elif char != '/':
+            board.append(char)
+    if len(board) != 64:
+        raise ValueError('Invalid FEN placement \'{}\'.'.format(placement))
+    return board
+
+
+def _can_capture_en_passant(board, square, black_to_move):
+    if len(square) != 2 or square[0] not in 'abcdefgh':
+        return False
+    file_idx = 'abcdefgh'.index(square[0])
+    # capturing pawns stand next to the pawn that moved two squares
+    row = 4 if black_to_move else 3
+    pawn = 'p' if black_to_move else 'P'
+    for capture_file in (file_idx - 1, file_idx + 1):
+        if 0 <= capture_file < 8 and board[row * 8 + capture_file] == pawn:
+            return True
+    return False